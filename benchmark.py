@@ -0,0 +1,335 @@
+"""
+Per-keystroke latency and throughput benchmark of the identifiers
+
+Each identifier (the log-norm KDIdentifier, TyperOracle and HmmOracle) is
+trained on part of a corpus, saved, and then fed every other file of the
+corpus one keystroke at a time, each file in a fresh session, as keydetect
+would.  Every identifier runs in a freshly spawned process, whose peak
+resident memory is read from /proc where available: ru_maxrss survives exec,
+so a child would otherwise report at least the parent's peak.
+
+The startup time of keydetect and of the typeroracle predict command is also
+measured, in fresh interpreters, against STARTUP_TARGETS.  The GUI needs a
+display, so keydetect is timed to the end of its imports.
+
+The results are written as JSON; --compare prints how they changed from an
+earlier run.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import hmm_oracle
+from kd_identify import KDIdentifier
+import kd_store
+import typeroracle
+
+ORACLES = ("log-norm", "typeroracle", "hmmoracle")
+# the longest each command may take from launch to exit, in seconds
+STARTUP_TARGETS = {"keydetect": 0.5, "typeroracle predict": 1.0}
+# the metrics --compare reports, and whether larger is better
+_COMPARED = (("train_seconds", False), ("model_bytes", False),
+             ("p50_us", False), ("p99_us", False), ("max_us", False),
+             ("keystrokes_per_second", True), ("peak_rss_bytes", False))
+
+def find_corpus(data_dir, train_names):
+    """
+     * data_dir is a directory of files named <id>_<name>
+     * train_names is a list of the names, e.g. "gettysburg.txt", of the
+       files each identity is trained on
+
+    returns (training, replays): a dictionary of id: [training files] for
+    every id that has all of train_names, and a list of (id, file) of every
+    other file of those ids
+    """
+    files = {}
+    for filename in sorted(os.listdir(data_dir)):
+        ident, sep, name = filename.partition("_")
+        if sep:
+            files.setdefault(ident, {})[name] = os.path.join(data_dir, filename)
+    training = {}
+    replays = []
+    for ident, names in files.items():
+        if not all(name in names for name in train_names):
+            continue
+        training[ident] = [names[name] for name in train_names]
+        replays.extend((ident, path) for name, path in names.items()
+                       if name not in train_names)
+    return training, replays
+
+def _peak_rss_bytes():
+    """
+    returns the peak resident memory of this process since it was started
+    """
+    # on Linux the high-water mark of /proc resets on exec, unlike ru_maxrss
+    try:
+        with open("/proc/self/status") as ifh:
+            for line in ifh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _train(name, training, directory):
+    """
+    trains the identifier called name and saves it under directory
+
+    returns (model, model_bytes)
+    """
+    if name == "log-norm":
+        model = KDIdentifier(training, history_length=200,
+                             use_log_norm_pdf=True)
+        # the identifier is its per-identity statistics
+        size = 0
+        for i, ident in enumerate(model.id_list):
+            path = os.path.join(directory, "stats%d%s" % (i, kd_store.EXTENSION))
+            model.pair_stats[ident].save(path)
+            size += os.path.getsize(path)
+        return model, size
+    path = os.path.join(directory, name + kd_store.EXTENSION)
+    if name == "typeroracle":
+        typeroracle.build_typeroracle(training).save(path)
+        model = typeroracle.TyperOracle.load(path)
+    else:
+        hmm_oracle.build_typeroracle(training).save(path)
+        model = hmm_oracle.HmmOracle.load(path)
+    return model, os.path.getsize(path)
+
+def run_oracle(name, training, replays, max_keystrokes=None):
+    """
+    benchmarks one identifier; meant to run in a process of its own
+     * name is one of ORACLES
+     * training is a dictionary of id: [training files]
+     * replays is a list of (id, file) to replay
+     * max_keystrokes, if given, replays only that many keystrokes of each
+       file
+
+    returns a dictionary of results
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        model, model_bytes = _train(name, training, directory)
+        train_seconds = time.perf_counter() - start
+
+        latencies = []
+        correct = 0
+        for ident, filename in replays:
+            asciicodes, timestamps = kd_store.load_keystrokes(filename)
+            asciicodes = asciicodes[:max_keystrokes].tolist()
+            timestamps = timestamps[:max_keystrokes].tolist()
+            session = model.new_session()
+            guess = None
+            clock = time.perf_counter_ns
+            for ascii_code, timestamp in zip(asciicodes, timestamps):
+                before = clock()
+                guess = model.step(session, ascii_code, timestamp)
+                latencies.append(clock() - before)
+            correct += (str(guess) == ident)
+    latencies = np.array(latencies, dtype=np.float64) / 1000.0
+    return {"train_seconds": train_seconds,
+            "model_bytes": model_bytes,
+            "keystrokes": len(latencies),
+            "p50_us": float(np.percentile(latencies, 50)),
+            "p99_us": float(np.percentile(latencies, 99)),
+            "max_us": float(latencies.max()),
+            "mean_us": float(latencies.mean()),
+            "keystrokes_per_second": float(len(latencies) / latencies.sum() * 1e6),
+            "final_guesses_correct": correct,
+            "replays": len(replays),
+            "peak_rss_bytes": _peak_rss_bytes()}
+
+def _run_isolated(args):
+    """
+    runs run_oracle in a fresh process, so that its peak memory is its own
+    """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_oracle, args)
+
+def _startup_commands(directory, training, replay_file):
+    """
+    trains a TyperOracle into directory for the predict command to load
+
+    returns a dictionary of name: command line, for each of STARTUP_TARGETS
+    """
+    model_path = os.path.join(directory, "typeroracle" + kd_store.EXTENSION)
+    typeroracle.build_typeroracle(training).save(model_path)
+    return {"keydetect": [sys.executable, "-c", "import keydetect"],
+            "typeroracle predict": [sys.executable, "typeroracle.py", "predict",
+                                    model_path, os.path.abspath(replay_file)]}
+
+def time_command(command, repeats=5):
+    """
+    runs command repeats times from the directory of this file
+
+    returns a list of the wall time of each run, in seconds
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=here, check=True, stdout=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+def run_startup(training, replays, repeats=5):
+    """
+    times the startup of each command of STARTUP_TARGETS
+     * training is a dictionary of id: [training files]
+     * replays is a list of (id, file); the first file is predicted
+     * repeats is the number of runs of each command
+
+    returns a dictionary of name: results
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        commands = _startup_commands(directory, training, replays[0][1])
+        for name, command in commands.items():
+            seconds = time_command(command, repeats)
+            median = float(np.median(seconds))
+            results[name] = {"median_seconds": median,
+                             "min_seconds": min(seconds),
+                             "target_seconds": STARTUP_TARGETS[name],
+                             "met": median <= STARTUP_TARGETS[name]}
+    return results
+
+def _commit():
+    """
+    returns the git commit of the working tree, or None
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(data_dir="data", train_names=("gettysburg.txt",
+                                                "gettysburg2.txt"),
+                  oracles=ORACLES, max_keystrokes=None, isolated=True,
+                  startup_repeats=5):
+    """
+    benchmarks each of oracles on the corpus in data_dir; see find_corpus
+    and run_oracle; unless startup_repeats is 0, startup is timed too, see
+    run_startup
+
+    returns a dictionary of results, with one entry per identifier
+    """
+    training, replays = find_corpus(data_dir, list(train_names))
+    if not training or not replays:
+        raise ValueError("no identities in %s have %s and other files to "
+                         "replay" % (data_dir, ", ".join(train_names)))
+    results = {"commit": _commit(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "identities": len(training),
+               "replay_files": len(replays),
+               "oracles": {}}
+    if startup_repeats:
+        results["startup"] = run_startup(training, replays, startup_repeats)
+    for name in oracles:
+        args = (name, training, replays, max_keystrokes)
+        results["oracles"][name] = \
+            _run_isolated(args) if isolated else run_oracle(*args)
+    return results
+
+def format_results(results, baseline=None):
+    """
+    returns results as readable text; with baseline, earlier results, each
+    metric is followed by its ratio to the baseline's
+    """
+    lines = ["commit %s, %d identities, %d replay files" % (
+        results["commit"], results["identities"], results["replay_files"])]
+    for name, result in results["oracles"].items():
+        lines.append("%s (%d keystrokes, %d/%d final guesses correct)" % (
+            name, result["keystrokes"], result["final_guesses_correct"],
+            result["replays"]))
+        before = None
+        if baseline is not None:
+            before = baseline["oracles"].get(name)
+        for metric, larger_is_better in _COMPARED:
+            line = "  %-22s %14.1f" % (metric, result[metric])
+            if before is not None and before.get(metric):
+                ratio = result[metric] / before[metric]
+                worse = ratio < 1 if larger_is_better else ratio > 1
+                line += "  x%.2f%s" % (ratio, " (worse)" if worse and
+                                       abs(ratio - 1) > 0.1 else "")
+            lines.append(line)
+    for name, result in results.get("startup", {}).items():
+        line = "startup %-22s %6.3fs (target %.3fs%s)" % (
+            name, result["median_seconds"], result["target_seconds"],
+            "" if result["met"] else ", MISSED")
+        before = None
+        if baseline is not None:
+            before = baseline.get("startup", {}).get(name)
+        if before is not None:
+            line += "  x%.2f" % (result["median_seconds"] /
+                                 before["median_seconds"])
+        lines.append(line)
+    return "\n".join(lines)
+
+def _run():
+    """
+    parses arguments and runs the benchmark
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-keystroke latency of the identifiers.")
+    parser.add_argument(
+        "--data-dir", default="data",
+        help="directory of files named <id>_<name> (default: data)")
+    parser.add_argument(
+        "--train", nargs="+", default=["gettysburg.txt", "gettysburg2.txt"],
+        help="names of the files each identity is trained on; every other "
+        "file is replayed")
+    parser.add_argument(
+        "--oracles", nargs="*", choices=ORACLES, default=list(ORACLES),
+        help="identifiers to benchmark; none to only time startup")
+    parser.add_argument(
+        "--max-keystrokes", type=int,
+        help="replay only this many keystrokes of each file")
+    parser.add_argument(
+        "--out", "-o", default="benchmark.json",
+        help="file to write the results to, as JSON (default: "
+        "benchmark.json)")
+    parser.add_argument(
+        "--compare", "-c",
+        help="results of an earlier run to compare with")
+    parser.add_argument(
+        "--in-process", action="store_true",
+        help="run every identifier in this process; peak memory is then "
+        "cumulative")
+    parser.add_argument(
+        "--startup-repeats", type=int, default=5,
+        help="number of runs of each command whose startup is timed; 0 "
+        "skips them (default: 5)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.data_dir, args.train, args.oracles,
+                            args.max_keystrokes, not args.in_process,
+                            args.startup_repeats)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as ifh:
+            baseline = json.load(ifh)
+    print(format_results(results, baseline))
+    with open(args.out, "w") as ofh:
+        json.dump(results, ofh, indent=1, sort_keys=True)
+    # a missed startup target fails the run, so that scripts notice
+    if not all(result["met"] for result in results.get("startup", {}).values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    _run()
@@ -1,75 +1,339 @@
-from kd_analyze import KDAnalyzer
-from kd_analyze import ItoATools
-from kd_identify import *
+from kd_identify import KDIdentifier
+from kd_stats import PairStats
 import typeroracle
 import hmm_oracle
+import kd_density
+import kd_store
+import pipeline
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
 import numpy
 np = numpy
 
+# Leave-one-out evaluation of the three identifiers.
+#
+# For every file base (e.g. "gettysburg") and every postfix, the files with that postfix
+# are held out for testing and the others train one fold.  Each fold's models are trained
+# once and saved under MODEL_CACHE_DIR, keyed by a hash of the training files' contents,
+# and the training settings, so rerunning an evaluation (or another evaluation sharing
+# folds) trains nothing.  The
+# (fold, identity) replays then run in a process pool; each worker loads the saved models,
+# which are memory-mapped rather than retrained.
 
-# id_names_files: dictionary
-# input_file: string
-def test_permutation(id_names_files, input_file):
+ORACLES = ["log-norm", "typeroracle", "hmmoracle"]
+MODEL_CACHE_DIR = os.path.join(kd_store.CACHE_DIR, "models")
+MANIFEST = "fold.json"
+HISTORY_LENGTH = 200
+TIME_INTERVAL_THRESHOLD = 1.2
+
+# Folds already loaded by this process, by fold directory
+_loaded_folds = dict()
+
+
+# *** build_folds ***
+# id_names: A list of identity names
+# file_base_names: A list of file base names, e.g. ["gettysburg"]
+# file_postfixes: A list of postfixes completing the file names, e.g. [".txt","2.txt"]
+# data_dir: The directory holding the files, named <id>_<base><postfix>
+# Returns: A list of folds, each a dictionary with the file base, the index of the held out
+#          postfix, id_names_files (the training files of each identity) and input_files
+#          (the held out file of each identity).  Files that do not exist are left out.
+def build_folds(id_names, file_base_names, file_postfixes, data_dir="data"):
+    folds = []
+    for file_base in file_base_names:
+        for leaveoutindex in range(0,len(file_postfixes)):
+            id_names_files = dict()
+            input_files = dict()
+            for id in id_names:
+                files_for_id = []
+                for i,postfix in enumerate(file_postfixes):
+                    filename = os.path.join(data_dir,id+"_"+file_base+postfix)
+                    if(not os.path.exists(filename)):
+                        continue
+                    if(i != leaveoutindex):
+                        files_for_id.append(filename)
+                    else:
+                        input_files[id] = filename
+                id_names_files[id] = files_for_id
+            folds.append({"file_base": file_base,
+                          "leaveoutindex": leaveoutindex,
+                          "id_names_files": id_names_files,
+                          "input_files": input_files})
+    return folds
+
+
+# *** build_settings ***
+# Returns: A dictionary of the settings the oracles are trained with: the default arguments
+#          of each build_typeroracle, which train_fold relies on, and kd_density's grid.
+def build_settings():
+    settings = {"grid_max": kd_density.DEFAULT_GRID_MAX,
+                "grid_step": kd_density.DEFAULT_GRID_STEP}
+    for name,module in (("typeroracle",typeroracle),("hmm_oracle",hmm_oracle)):
+        parameters = inspect.signature(module.build_typeroracle).parameters
+        settings[name] = {parameter.name: parameter.default
+                          for parameter in parameters.values()
+                          if parameter.default is not inspect.Parameter.empty
+                          and parameter.name not in ("workers","timer")}
+    return settings
+
+
+# *** training_key ***
+# id_names_files: A dictionary of identity name: list of training files
+# Returns: A hex digest identifying the training set by the identities, in order, and the
+#          contents of their files, along with the training parameters.
+def training_key(id_names_files):
+    digest = hashlib.sha1()
+    digest.update(json.dumps({"history_length": HISTORY_LENGTH,
+                              "time_interval_threshold": TIME_INTERVAL_THRESHOLD,
+                              "typeroracle": typeroracle.MODEL_VERSION,
+                              "hmm_oracle": hmm_oracle.MODEL_VERSION,
+                              "settings": build_settings()},
+                             sort_keys=True).encode("utf-8"))
+    for id in id_names_files:
+        digest.update(json.dumps(id).encode("utf-8"))
+        for file_hash in sorted(kd_store.file_hash(f) for f in id_names_files[id]):
+            digest.update(file_hash.encode("ascii"))
+    return digest.hexdigest()
 
-    # Open the input file
-    inputdata = numpy.loadtxt(input_file)
-    asciicodes = inputdata[:,0].astype(numpy.int64)
-    timestamps = inputdata[:,1]
 
-    kdidentifier = KDIdentifier(id_names_files,
-                                history_length=200,
+# *** train_fold ***
+# Trains the models of one fold, unless they are already cached.
+# id_names_files: A dictionary of identity name: list of training files
+# cache_dir: The directory holding one subdirectory of saved models per fold
+# workers: The number of worker processes each training may use
+# retrain: Whether to train even when the models are cached
+# Returns: fold_dir, the directory of the saved models, and the manifest describing them,
+#          including the training time of each oracle.
+def train_fold(id_names_files, cache_dir=MODEL_CACHE_DIR, workers=1, retrain=False):
+    fold_dir = os.path.join(cache_dir,training_key(id_names_files))
+    manifest_path = os.path.join(fold_dir,MANIFEST)
+    if(not retrain and os.path.exists(manifest_path)):
+        with open(manifest_path) as ifh:
+            manifest = json.load(ifh)
+        manifest["cached"] = True
+        return fold_dir,manifest
+    os.makedirs(fold_dir,exist_ok=True)
+
+    train_seconds = dict()
+    start = time.perf_counter()
+    for i,id in enumerate(id_names_files):
+        stats = PairStats.from_files(id_names_files[id],TIME_INTERVAL_THRESHOLD)
+        stats.save(os.path.join(fold_dir,"stats%d%s" % (i,kd_store.EXTENSION)))
+    train_seconds["log-norm"] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    typeroracle.build_typeroracle(id_names_files,workers=workers).save(
+        os.path.join(fold_dir,"typeroracle"+kd_store.EXTENSION))
+    train_seconds["typeroracle"] = time.perf_counter()-start
+
+    start = time.perf_counter()
+    hmm_oracle.build_typeroracle(id_names_files,workers=workers).save(
+        os.path.join(fold_dir,"hmmoracle"+kd_store.EXTENSION))
+    train_seconds["hmmoracle"] = time.perf_counter()-start
+
+    # The manifest is written last, so a fold with a manifest is complete
+    manifest = {"ids": list(id_names_files),
+                "id_names_files": id_names_files,
+                "train_seconds": train_seconds}
+    tmppath = "%s.%d.tmp" % (manifest_path,os.getpid())
+    with open(tmppath,"w") as ofh:
+        json.dump(manifest,ofh,indent=1)
+    os.replace(tmppath,manifest_path)
+    manifest["cached"] = False
+    return fold_dir,manifest
+
+
+# *** load_fold ***
+# fold_dir: A directory written by train_fold
+# Returns: A dictionary of oracle name: trained model.
+def load_fold(fold_dir):
+    if(fold_dir in _loaded_folds):
+        return _loaded_folds[fold_dir]
+    with open(os.path.join(fold_dir,MANIFEST)) as ifh:
+        manifest = json.load(ifh)
+    kdidentifier = KDIdentifier(dict(),
+                                time_interval_threshold=TIME_INTERVAL_THRESHOLD,
+                                history_length=HISTORY_LENGTH,
                                 use_log_norm_pdf=True)
-                                
-    tyoracidentifier = typeroracle.build_typeroracle(id_names_files)
-    
-    hmmoracidentifier = hmm_oracle.build_typeroracle(id_names_files)
-
-    # Now, iterate through each pair of letters, as if getting them from a live-stream
-    for i in range(0,len(timestamps)):
-        #print("flag,",i)
-        kdidentifier.processKeystroke(asciicodes[i],timestamps[i])
-        typeroracle_guess = tyoracidentifier.process_keystroke(asciicodes[i],timestamps[i])
-        hmmoracle_guess = hmmoracidentifier.process_keystroke(asciicodes[i],timestamps[i])
-
-    return {"log-norm": kdidentifier.guess,
-            "typeroracle" : typeroracle_guess,
-            "hhmoracle" : hmmoracle_guess}
-
-
-
-id_names = ["joseph", "steven", "nozomu", "wilson", "lawrence", "jeff"]
-file_base_names = ["gettysburg"]
-file_postfixes = [".txt","2.txt","3.txt"]
-
-
-for file_base in file_base_names:
-    print("File: ",file_base)
-    for leaveoutindex in range(0,3):
-    
-        print("Input index used for testing: ",leaveoutindex, " (others used for training)")
-    
-        # Construct the training data input, and test input file list
-        id_names_files = dict()
-        input_files = dict()
+    for i,id in enumerate(manifest["ids"]):
+        stats = PairStats.load(os.path.join(fold_dir,"stats%d%s" % (i,kd_store.EXTENSION)))
+        kdidentifier.enroll_stats(id,stats,manifest["id_names_files"][id])
+    models = {"log-norm": kdidentifier,
+              "typeroracle": typeroracle.TyperOracle.load(
+                  os.path.join(fold_dir,"typeroracle"+kd_store.EXTENSION)),
+              "hmmoracle": hmm_oracle.HmmOracle.load(
+                  os.path.join(fold_dir,"hmmoracle"+kd_store.EXTENSION))}
+    _loaded_folds[fold_dir] = models
+    return models
+
+
+# *** test_permutation ***
+# Replays one held out file through every oracle of a fold, as if from a live stream.
+# models: A dictionary of oracle name: trained model, as from load_fold
+# input_file: The file to replay
+# Returns: guesses, a dictionary of oracle name: final guess, and seconds, a dictionary of
+#          oracle name: time taken to replay the file.
+def test_permutation(models, input_file):
+
+    # Open the input file
+    asciicodes, timestamps = kd_store.load_keystrokes(input_file)
+    guesses = dict()
+    seconds = dict()
+
+    # The log-norm identifier replays the whole file at once
+    start = time.perf_counter()
+    kdidentifier_guesses, _ = models["log-norm"].process_batch(asciicodes,timestamps)
+    guesses["log-norm"] = str(kdidentifier_guesses[-1])
+    seconds["log-norm"] = time.perf_counter()-start
+
+    # The others iterate through each pair of letters, each in a session of its own
+    for name in ["typeroracle","hmmoracle"]:
+        oracle = models[name]
+        session = oracle.new_session()
+        start = time.perf_counter()
+        guess = None
+        for i in range(0,len(timestamps)):
+            guess = oracle.step(session,int(asciicodes[i]),float(timestamps[i]))
+        guesses[name] = str(guess)
+        seconds[name] = time.perf_counter()-start
+    return guesses,seconds
+
+
+# *** _replay ***
+# Runs in a worker process.
+# task: A tuple (fold index, fold_dir, id, input_file)
+# Returns: A dictionary describing the replay.
+def _replay(task):
+    foldindex,fold_dir,id,input_file = task
+    guesses,seconds = test_permutation(load_fold(fold_dir),input_file)
+    return {"fold": foldindex,
+            "id": id,
+            "input_file": input_file,
+            "keystrokes": len(kd_store.load_keystrokes(input_file)[0]),
+            "guesses": guesses,
+            "seconds": seconds}
+
+
+# *** summarize ***
+# id_names: A list of identity names
+# replays: A list of replay results, from _replay
+# manifests: A list of the manifests of the folds, from train_fold
+# Returns: A dictionary with, for each oracle, its accuracy, confusion matrix (as a
+#          dictionary of true id: {guess: count}), training time and replay time.
+def summarize(id_names, replays, manifests):
+    report = dict()
+    keystrokes = sum(r["keystrokes"] for r in replays)
+    for name in ORACLES:
+        confusion = {id: dict() for id in id_names}
+        correct = 0
+        for r in replays:
+            guess = r["guesses"][name]
+            confusion[r["id"]][guess] = confusion[r["id"]].get(guess,0)+1
+            correct += (guess == r["id"])
+        replay_seconds = sum(r["seconds"][name] for r in replays)
+        report[name] = {"accuracy": correct/len(replays) if replays else float("nan"),
+                        "correct": correct,
+                        "tests": len(replays),
+                        "confusion": confusion,
+                        "train_seconds": sum(m["train_seconds"][name] for m in manifests),
+                        "replay_seconds": replay_seconds,
+                        "us_per_keystroke": 1e6*replay_seconds/max(keystrokes,1)}
+    return report
+
+
+# *** format_report ***
+# Returns: The report from summarize as readable text.
+def format_report(id_names, report):
+    lines = []
+    for name in ORACLES:
+        r = report[name]
+        lines.append("%s: accuracy %.3f (%d/%d), trained in %.2fs, replayed at %.1fus/keystroke"
+                     % (name,r["accuracy"],r["correct"],r["tests"],r["train_seconds"],
+                        r["us_per_keystroke"]))
+        guesses = list(id_names)
         for id in id_names:
-            files_for_id = []
-            input_file = ""
-            for i,postfix in enumerate(file_postfixes):
-                filename = "data/"+id+"_"+file_base+postfix
-                if(i != leaveoutindex):   
-                    files_for_id.append(filename)
-                else:
-                    input_file = filename
-            id_names_files[id] = files_for_id
-            input_files[id] = input_file
-
-        # Now we do the testing
+            guesses.extend(g for g in r["confusion"][id] if g not in guesses)
+        width = max(len(g) for g in guesses+["true \\ guess"])+1
+        lines.append("  "+"true \\ guess".ljust(width)+"".join(g.rjust(width) for g in guesses))
         for id in id_names:
+            lines.append("  "+id.ljust(width)+"".join(
+                str(r["confusion"][id].get(g,0)).rjust(width) for g in guesses))
+    return "\n".join(lines)
+
+
+# *** evaluate ***
+# Trains (or loads) every fold's models and replays every held out file.
+# folds: A list of folds, from build_folds
+# workers: The number of worker processes
+# cache_dir: The directory of saved models
+# retrain: Whether to train even when the models are cached
+# timer: A pipeline.StageTimer to record stages and report progress
+# Returns: replays, the list of replay results, and manifests, one for each fold.
+def evaluate(folds, workers=1, cache_dir=MODEL_CACHE_DIR, retrain=False, timer=None):
+    if(timer is None):
+        timer = pipeline.StageTimer("compute_results")
+    manifests = []
+    tasks = []
+    with timer.stage("train"):
+        for foldindex,fold in enumerate(folds):
+            fold_dir,manifest = train_fold(fold["id_names_files"],cache_dir,workers,retrain)
+            timer.log("fold %d (%s, held out %d): %s" % (
+                foldindex,fold["file_base"],fold["leaveoutindex"],
+                "cached" if manifest["cached"] else "trained"))
+            manifests.append(manifest)
+            for id,input_file in fold["input_files"].items():
+                tasks.append((foldindex,fold_dir,id,input_file))
+    with timer.stage("replay"):
+        replays = pipeline.parallel_map(
+            _replay,tasks,workers,
+            on_done=lambda done: timer.progress("replay",done,len(tasks)))
+    return replays,manifests
+
+
+def _run():
+    parser = argparse.ArgumentParser(
+        description="Leave-one-out evaluation of the typist identifiers.")
+    parser.add_argument("--ids",nargs="+",
+                        default=["joseph","steven","nozomu","wilson","lawrence","jeff"],
+                        help="identities to evaluate")
+    parser.add_argument("--bases",nargs="+",default=["gettysburg"],
+                        help="file base names; each gives its own set of folds")
+    parser.add_argument("--postfixes",nargs="+",default=[".txt","2.txt","3.txt"],
+                        help="postfixes completing the file names; each is held out in turn")
+    parser.add_argument("--data-dir",default="data",
+                        help="directory holding the files, named <id>_<base><postfix>")
+    parser.add_argument("--workers","-j",type=int,default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--cache-dir",default=MODEL_CACHE_DIR,
+                        help="directory of trained models (default: %s)" % MODEL_CACHE_DIR)
+    parser.add_argument("--retrain",action="store_true",
+                        help="train every fold even when its models are cached")
+    parser.add_argument("--out","-o",
+                        help="file to write the report to, as JSON")
+    parser.add_argument("--verbose","-v",action="store_true",
+                        help="report progress and per-stage timings")
+    args = parser.parse_args()
 
-            # Test on each test input.
-            guess = test_permutation(id_names_files,input_files[id])
-            print("Guess for '"+id+"': "+str(guess))
+    timer = pipeline.StageTimer("compute_results",verbose=args.verbose)
+    folds = build_folds(args.ids,args.bases,args.postfixes,args.data_dir)
+    replays,manifests = evaluate(folds,args.workers,args.cache_dir,args.retrain,timer)
 
-    
+    for r in replays:
+        fold = folds[r["fold"]]
+        print("File: %s, input index used for testing: %d, guess for '%s': %s"
+              % (fold["file_base"],fold["leaveoutindex"],r["id"],r["guesses"]))
+    report = summarize(args.ids,replays,manifests)
+    print(format_report(args.ids,report))
+    timer.log("stage timings:\n"+timer.report())
+    if(args.out is not None):
+        with open(args.out,"w") as ofh:
+            json.dump({"folds": folds,"replays": replays,"oracles": report,
+                       "stage_seconds": timer.timings},ofh,indent=1)
 
 
+if __name__ == "__main__":
+    _run()
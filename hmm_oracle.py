@@ -8,28 +8,248 @@ import argparse
 import numpy as np
 import os
 import pickle
-from sklearn.neighbors import KernelDensity
 import sys
-from hmmlearn import hmm
+import time
+import kd_pairs
+import kd_store
+import pipeline
+from instrumentation import Instrumented, clock
 
 HISTORY_LENGTH = 200
+# the live forward pass may run this many key-pairs past HISTORY_LENGTH
+# before it is recomputed over exactly the last HISTORY_LENGTH
+CHECKPOINT_INTERVAL = 50
+# identifies saved HmmOracles, and the version of their layout
+MODEL_KIND = "hmm_oracle"
+MODEL_VERSION = 1
+# the fitted parameters of a GaussianHMM, as stored in a saved HmmOracle
+_HMM_PARAMS = ("startprob_", "transmat_", "means_", "covars_")
 
-class HmmOracle:
+class HmmSession:
     """
-    A struct to store information for predicting typer
+    The live state of one typer being predicted by a shared HmmOracle
+
+    The last HISTORY_LENGTH key-pairs are kept in a ring buffer, and every
+    model keeps its scaled forward vector and the log-likelihood of the
+    key-pairs it has seen, so a keystroke costs one forward step per model.
+    """
+    __slots__ = ("observations", "position", "num_observations", "covered",
+                 "alpha", "logliks", "last_timestamp", "last_keypress")
+
+    def __init__(self, num_models, num_states, num_features):
+        self.observations = np.zeros((HISTORY_LENGTH, num_features))
+        self.position = 0
+        self.num_observations = 0
+        # number of the latest key-pairs that alpha and logliks account for
+        self.covered = 0
+        self.alpha = np.zeros((num_models, num_states))
+        self.logliks = np.zeros(num_models)
+        self.last_timestamp = -1
+        self.last_keypress = -1
+
+class StackedForward:
+    """
+    The scaled forward algorithm of several GaussianHMMs, run side by side
+
+    Models with fewer states than the largest are padded with states that
+    can never be reached, so one step of every model is a few vectorized
+    operations.
     """
 
     def __init__(self, models):
         """
-         * keypairlist must be a list of key-pair tuples
-         * userlist must be a list of labels
-         * labeledkdes must be a dictionary of label: {keypair: kde}
+         * models must be a list of trained hmm.GaussianHMM that take the
+           same number of features
+        """
+        num_states = max(model.n_components for model in models)
+        num_features = models[0].means_.shape[1]
+        shape = (len(models), num_states)
+        self.num_states = num_states
+        self.num_features = num_features
+        self.startprob = np.zeros(shape)
+        self.transmat = np.zeros(shape + (num_states,))
+        self.means = np.zeros(shape + (num_features,))
+        self.precisions = np.tile(np.eye(num_features), shape + (1, 1))
+        self.log_norms = np.full(shape, -np.inf)
+        for i, model in enumerate(models):
+            n = model.n_components
+            covars = model.covars_
+            self.startprob[i, :n] = model.startprob_
+            self.transmat[i, :n, :n] = model.transmat_
+            self.means[i, :n] = model.means_
+            self.precisions[i, :n] = np.linalg.inv(covars)
+            self.log_norms[i, :n] = -0.5 * (
+                num_features * np.log(2 * np.pi) +
+                np.linalg.slogdet(covars)[1])
+
+    def log_emissions(self, observations):
+        """
+        returns an array of shape (..., models, states) of the log-density of
+        each observation (an array of shape (..., features)) in each state
+        """
+        diff = observations[..., None, None, :] - self.means
+        return self.log_norms - 0.5 * np.einsum(
+            "...msf,msfg,...msg->...ms", diff, self.precisions, diff)
+
+    def start(self, observation):
+        """
+        returns (alpha, logc): the scaled forward vectors of every model after
+        the first observation, and the log-likelihood of that observation
+        """
+        return self._emit(self.startprob, self.log_emissions(observation))
+
+    def advance(self, alpha, observation):
+        """
+        returns (alpha, logc): the scaled forward vectors of every model after
+        observation, and the log-likelihood of observation given the ones
+        before it
+        """
+        return self._emit(np.einsum("ms,mst->mt", alpha, self.transmat),
+                          self.log_emissions(observation))
+
+    def run(self, observations):
         """
+        returns (alpha, logliks): the scaled forward vectors of every model
+        after the array of observations, and their total log-likelihood
+        """
+        log_emissions = self.log_emissions(observations)
+        alpha, logliks = self._emit(self.startprob, log_emissions[0])
+        for step_emissions in log_emissions[1:]:
+            alpha, logc = self._emit(
+                np.einsum("ms,mst->mt", alpha, self.transmat), step_emissions)
+            logliks = logliks + logc
+        return alpha, logliks
+
+    @staticmethod
+    def _emit(predicted, log_emissions):
+        """
+        weighs the predicted state probabilities by the emission densities of
+        an observation and rescales them to sum to one
+        """
+        top = log_emissions.max(axis=1)
+        alpha = predicted * np.exp(log_emissions - top[:, None])
+        total = alpha.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            logc = np.log(total) + top
+            # a model that cannot emit the observation keeps its prediction
+            alpha = np.where(total[:, None] > 0, alpha / total[:, None],
+                             predicted)
+        return alpha, logc
+
+class HmmOracle(Instrumented):
+    """
+    A struct to store information for predicting typer
+
+    The trained models are never modified after construction, so one oracle
+    can serve many typers at once, each with its own HmmSession (see
+    sessions).  process_keystroke uses a default session of the oracle's own.
+
+    Live scores come from a forward pass updated at every key-pair.  By
+    default they cover the last HISTORY_LENGTH key-pairs: the pass runs on
+    for up to checkpoint - 1 more, then is recomputed from the ring buffer.
+    With forgetting, old key-pairs instead fade away exponentially and the
+    pass is never recomputed.  enable_instrumentation records the time of each
+    stage of step, and stats() returns it (see instrumentation).
+    """
+
+    def __init__(self, models, forgetting=None,
+                 checkpoint=CHECKPOINT_INTERVAL):
+        """
+         * models must be a dictionary of label: trained hmm.GaussianHMM
+         * forgetting, if given, is a factor between 0 and 1 by which the live
+           log-likelihoods decay at every key-pair, instead of covering a
+           sliding window
+         * checkpoint is how many key-pairs past HISTORY_LENGTH the live
+           forward pass may cover, at most, before it is recomputed; with 1,
+           it covers exactly the last HISTORY_LENGTH key-pairs
+        """
+        if forgetting is not None and not 0 < forgetting <= 1:
+            raise ValueError("forgetting must be in (0, 1]")
+        if checkpoint < 1:
+            raise ValueError("checkpoint must be at least 1")
         self.models = models
-        self.history = []
-        self.currentdata = {}
-        self.last_timestamp = -1
-        self.last_keypress = -1
+        self.forgetting = forgetting
+        self.checkpoint = checkpoint
+        self._stack_models()
+        self.session = self.new_session()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("session", None)
+        state.pop("labels", None)
+        state.pop("forward", None)
+        state.pop("instruments", None)
+        return state
+
+    def __setstate__(self, state):
+        # oracles pickled before sessions were split out carry their live state
+        for key in ("history", "currentdata", "last_timestamp",
+                    "last_keypress"):
+            state.pop(key, None)
+        state.setdefault("forgetting", None)
+        state.setdefault("checkpoint", CHECKPOINT_INTERVAL)
+        self.__dict__.update(state)
+        self._stack_models()
+        self.session = self.new_session()
+
+    def _stack_models(self):
+        """
+        prepares the models for scoring side by side
+        """
+        self.labels = list(self.models)
+        self.forward = StackedForward([self.models[label]
+                                       for label in self.labels])
+
+    def save(self, path):
+        """
+        writes the trained models to path, as a kd_store file
+         * path is the name of the file to write
+        """
+        models = []
+        columns = {}
+        for i, (label, model) in enumerate(self.models.items()):
+            models.append({"label": label,
+                           "n_components": model.n_components,
+                           "covariance_type": model.covariance_type})
+            for param in _HMM_PARAMS:
+                # covars_ expands diagonal covariances to full matrices;
+                # _covars_ is the compact form its setter takes back
+                attr = "_covars_" if param == "covars_" else param
+                columns["%s%d" % (param, i)] = getattr(model, attr)
+        kd_store.write_columns(path, columns, {"kind": MODEL_KIND,
+                                               "version": MODEL_VERSION,
+                                               "models": models})
+
+    @classmethod
+    def load(cls, path, forgetting=None, checkpoint=CHECKPOINT_INTERVAL):
+        """
+        returns the HmmOracle saved to path by save; forgetting and checkpoint
+        are as for the constructor
+        """
+        meta, columns = kd_store.read_columns(path)
+        if meta.get("kind") != MODEL_KIND:
+            raise ValueError("%s does not hold an HmmOracle" % path)
+        if meta.get("version", 0) > MODEL_VERSION:
+            raise ValueError("%s was saved by a newer version (%r)" %
+                             (path, meta["version"]))
+        # hmmlearn is slow to import, so only the paths building models do
+        from hmmlearn import hmm
+        models = {}
+        for i, spec in enumerate(meta["models"]):
+            model = hmm.GaussianHMM(n_components=spec["n_components"],
+                                    covariance_type=spec["covariance_type"])
+            for param in _HMM_PARAMS:
+                setattr(model, param, np.array(columns["%s%d" % (param, i)]))
+            model.n_features = model.means_.shape[1]
+            models[spec["label"]] = model
+        return cls(models, forgetting, checkpoint)
+
+    def new_session(self):
+        """
+        returns an HmmSession for a new typer
+        """
+        return HmmSession(len(self.labels), self.forward.num_states,
+                          self.forward.num_features)
 
     def predict(self, history):
         """
@@ -65,78 +285,190 @@ class HmmOracle:
          * ascii_code is an integer code for the latest key press
          * timestamp is a float of the timestamp for the key press
         """
-        if len(self.history) == 0 and self.last_keypress == -1:
-            self.last_keypress = ascii_code
-            self.last_timestamp = timestamp
+        return self.step(self.session, ascii_code, timestamp)
+
+    def step(self, session, ascii_code, timestamp):
+        """
+        for predicting live, for one of many typers
+         * session is the HmmSession of the typer
+         * ascii_code is an integer code for the latest key press
+         * timestamp is a float of the timestamp for the key press
+        """
+        if session.num_observations == 0 and session.last_keypress == -1:
+            session.last_keypress = ascii_code
+            session.last_timestamp = timestamp
             return "I don't know"
-        dt = timestamp - self.last_timestamp
-        self.history.append([self.last_keypress, ascii_code, dt])
-        self.last_keypress = ascii_code
-        # self._update_currentdata(timestamp)
-        self.last_timestamp = timestamp
-        return self.predict(self.history[-HISTORY_LENGTH:])
+        instruments = self.instruments
+        if instruments is not None:
+            start = clock()
+        observation = session.observations[session.position]
+        observation[:] = (session.last_keypress, ascii_code,
+                          timestamp - session.last_timestamp)
+        session.position = (session.position + 1) % HISTORY_LENGTH
+        session.num_observations += 1
+        session.last_keypress = ascii_code
+        session.last_timestamp = timestamp
+        if session.covered == 0:
+            session.alpha, session.logliks = self.forward.start(observation)
+            session.covered = 1
+            stage = "forward"
+        elif self.forgetting is None and \
+                session.covered >= HISTORY_LENGTH + self.checkpoint - 1:
+            self._recompute(session)
+            stage = "recompute"
+        else:
+            session.alpha, logc = self.forward.advance(session.alpha,
+                                                       observation)
+            if self.forgetting is not None:
+                session.logliks *= self.forgetting
+            session.logliks += logc
+            session.covered += 1
+            stage = "forward"
+        if instruments is not None:
+            argmax_start = clock()
+            instruments.record(stage, argmax_start - start)
+            instruments.count("forward_steps",
+                              session.covered if stage == "recompute" else 1)
+            instruments.count("model_updates", len(self.labels))
+        guess = self._best_label(session.logliks)
+        if instruments is not None:
+            end = clock()
+            instruments.record("argmax", end - argmax_start)
+            instruments.record("keystroke", end - start)
+            instruments.count("keystrokes")
+            instruments.tick()
+        return guess
 
-    def _update_currentdata(self, timestamp):
+    def _recompute(self, session):
         """
         this method really shouldn't every be called outside of the class, since
-        this method will change the state of the class
-         * timestamp is a float of the timestamp for the latest key press
+        this method will change the state of the session; it reruns the forward
+        pass over the key-pairs in the ring buffer, oldest first
         """
-        if self.history[-1] not in self.currentdata:
-            self.currentdata[self.history[-1]] = []
-        self.currentdata[self.history[-1]].append(timestamp - self.last_timestamp)
-        if len(self.history) > HISTORY_LENGTH:
-            if len(self.currentdata[self.history[0]]) == 1:
-                self.currentdata.pop(self.history[0])
-            else:
-                self.currentdata[self.history[0]].pop(0)
-            self.history = self.history[-HISTORY_LENGTH:]
+        count = min(session.num_observations, HISTORY_LENGTH)
+        order = (session.position - count + np.arange(count)) % HISTORY_LENGTH
+        session.alpha, session.logliks = self.forward.run(
+            session.observations[order])
+        session.covered = count
 
-def build_typeroracle(training):
+    def _best_label(self, logliks):
+        """
+        returns the label of the model with the highest log-likelihood, as
+        predict would
+        """
+        best = int(np.argmax(logliks))
+        if not logliks[best] > float("-inf"):
+            return "who knows?"
+        return self.labels[best]
+
+def build_typeroracle(training, n_components=3, restarts=1, workers=1,
+                      timer=None, seed=None, n_iter=10):
     """
      * training is a dictionary of label: [training files]
+     * n_components is the number of hidden states of each user's model
+     * restarts is the number of models fitted per user from different
+       random initializations; the one with the best likelihood is kept
+     * workers is the number of threads loading files and of processes
+       fitting models
+     * timer, if given, is a pipeline.StageTimer that records the time of
+       each stage and reports progress and each user's fit
+     * seed, if given, seeds the random initializations
+     * n_iter is the largest number of EM iterations of each fit
 
-    returns a TyperOracle
+    returns an HmmOracle
     """
+    if timer is None:
+        timer = pipeline.StageTimer("hmm_oracle")
     userlist = [label for label in training]
-    labeledtimelists = _get_training_data(training, userlist)
-
+    with timer.stage("load"):
+        labeledtimelists = _get_training_data(training, userlist, workers)
+    for label in userlist:
+        if not any(len(sequence) for sequence in labeledtimelists[label]):
+            raise ValueError("no key-pairs to train %s on in %s" % (
+                label, ", ".join(training[label]) or "no files"))
+    with timer.stage("fit"):
+        results = pipeline.parallel_map(
+            _fit_user_model,
+            [(labeledtimelists[label], n_components, restarts, seed, n_iter)
+             for label in userlist],
+            workers,
+            on_done=lambda done: timer.progress("fit", done, len(userlist)))
     models = {}
-    for k, v in labeledtimelists.items():
-        X = v[0]
-        lengths = []
-        for i in range(1, len(v)):
-            data_set = np.array(v[i])
-            X = np.concatenate([X, data_set])
-            lengths.append(len(data_set))
-        m = hmm.GaussianHMM(n_components=3)
-        m.fit(X, lengths)
-        models[k] = m
-
-    # notinall = _get_limited_keypairs(userlist, labeledtimelists)
-    # prekeypairlist = _get_legal_keypairs(labeledtimelists, notinall)
-    # keypairlist = prekeypairlist
-    # labeledkdes = _build_labeledkdes(keypairlist, userlist, labeledtimelists)
-    # return TyperOracle(keypairlist, userlist, labeledkdes)
+    for label, (model, stats) in zip(userlist, results):
+        timer.log("%s: %d sequences, %d key-pairs, log-likelihood %.1f, "
+                  "%d iterations%s, %d restarts in %.2fs" % (
+                      label, stats["sequences"], stats["observations"],
+                      stats["loglik"], stats["iterations"],
+                      "" if stats["converged"] else " (not converged)",
+                      restarts, stats["seconds"]))
+        models[label] = model
     return HmmOracle(models)
 
+def _stack_sequences(sequences):
+    """
+     * sequences is a list of arrays with one row per key-pair
+
+    returns (X, lengths): the non-empty sequences one after another in a
+    single array, and their lengths, as GaussianHMM.fit takes them
+    """
+    sequences = [sequence for sequence in sequences if len(sequence)]
+    if not sequences:
+        raise ValueError("every sequence is empty")
+    lengths = [len(sequence) for sequence in sequences]
+    X = np.empty((sum(lengths), sequences[0].shape[1]))
+    position = 0
+    for sequence in sequences:
+        X[position:position + len(sequence)] = sequence
+        position += len(sequence)
+    return X, lengths
+
+def _fit_user_model(args):
+    """
+    fits the model of one user; runs in a worker process
+     * args is a tuple (sequences, n_components, restarts, seed, n_iter)
+
+    returns (model, stats), where stats is a dictionary describing the fit
+    """
+    from hmmlearn import hmm
+    sequences, n_components, restarts, seed, n_iter = args
+    start = time.perf_counter()
+    X, lengths = _stack_sequences(sequences)
+    bestmodel = None
+    bestscore = float("-inf")
+    for restart in range(restarts):
+        model = hmm.GaussianHMM(
+            n_components=n_components, n_iter=n_iter,
+            random_state=None if seed is None else seed + restart)
+        model.fit(X, lengths)
+        score = model.score(X, lengths)
+        if bestmodel is None or score > bestscore:
+            bestmodel = model
+            bestscore = score
+    # hmmlearn's monitor also calls running out of iterations convergence
+    history = bestmodel.monitor_.history
+    converged = len(history) >= 2 and \
+        abs(history[-1] - history[-2]) < bestmodel.monitor_.tol
+    return bestmodel, {"seconds": time.perf_counter() - start,
+                       "sequences": len(lengths),
+                       "observations": len(X),
+                       "loglik": bestscore,
+                       "iterations": bestmodel.monitor_.iter,
+                       "converged": converged}
+
 def _load_data(filename):
     """
     extracts key-pair information and the time elapsed between the first key
     press and the second key press of each key-pair
      * filename is the name of a file from which to load data; each line should
        contain <integer><whitespace><float>, where the integer is an ascii key
-       code and the float is the timestamp when the key was pressed
+       code and the float is the timestamp when the key was pressed; binary
+       files written by kd_store are also accepted
 
-    returns dictionary of keypair: [timings]
+    returns an array with one row [first key, second key, timing] per key-pair
     """
-    rawdata = np.loadtxt(filename)
-    asciicodes = rawdata[:, 0].astype(np.int64)
-    timestamps = rawdata[:, 1]
-
-    keypair = [(a, b) for a, b in zip(asciicodes[:-1], asciicodes[1:])]
-    timings = np.diff(timestamps)
-    result = [[a[0], a[1], b] for a, b in zip(keypair, timings)]
+    codes, timings = kd_pairs.load_pairs(filename)
+    first, second = np.divmod(codes, kd_pairs.KEY_RADIX)
+    result = np.column_stack((first, second, timings))
 
     # result = {}
     # for k, time in zip(keypair, timings):
@@ -146,28 +478,32 @@ def _load_data(filename):
     #         result[k] = [time]
     return result
 
-def _get_training_data(training, userlist):
+def _get_training_data(training, userlist, workers=1):
     """
      * training is a dictionary of label: [training files]
      * userlist is a list of users
+     * workers is the number of threads loading files
 
-    returns a dictionary of label: {keypair: [timing]}
+    returns a dictionary of label: [array of key-pairs], one array per file
     """
+    filenames = [filename for label in userlist for filename in training[label]]
+    alldata = iter(pipeline.parallel_map(_load_data, filenames, workers,
+                                         threads=True))
     labeledtimelists = {}
     for label in userlist:
-        for filename in training[label]:
-            data = _load_data(filename)
-            if label not in labeledtimelists:
-                labeledtimelists[label] = []
-            labeledtimelists[label].append(data)
-            # if label not in labeledtimelists:
-            #     labeledtimelists[label] = {}
-            # for keypair in data:
-            #     if keypair not in labeledtimelists[label]:
-            #         labeledtimelists[label][keypair] = []
-            #     labeledtimelists[label][keypair].extend(data[keypair])
+        labeledtimelists[label] = [next(alldata) for _ in training[label]]
     return labeledtimelists
 
+def load_hmmoracle(filename):
+    """
+    returns the HmmOracle in filename, written by HmmOracle.save or, for
+    models trained before that format existed, pickled
+    """
+    if kd_store.is_store_file(filename):
+        return HmmOracle.load(filename)
+    with open(filename, "rb") as ifh:
+        return pickle.load(ifh)
+
 def _train_model(args):
     """
     runs training task
@@ -177,17 +513,21 @@ def _train_model(args):
         curdir = os.path.join(args.dir, dirname)
         training[dirname] = [os.path.join(
             curdir, a) for a in os.listdir(curdir)]
-    oracle = build_typeroracle(training)
-    with open(args.out, "wb") as ofh:
-        pickle.dump(oracle, ofh)
+    timer = pipeline.StageTimer("hmm_oracle", verbose=args.verbose)
+    oracle = build_typeroracle(training, n_components=args.states,
+                               restarts=args.restarts, workers=args.workers,
+                               timer=timer, seed=args.seed,
+                               n_iter=args.iterations)
+    with timer.stage("save"):
+        oracle.save(args.out)
+    timer.log("stage timings:\n" + timer.report())
 
 def _predict_user(args):
     """
     runs prediction task
     """
     data = _load_data(args.input)
-    with open(args.model, "rb") as ifh:
-        oracle = pickle.load(ifh)
+    oracle = load_hmmoracle(args.model)
     print(oracle.predict(data))
 
 def _run():
@@ -210,6 +550,35 @@ def _run():
     trainparser.add_argument(
         "out",
         help="name of output file in which trained model is saved")
+    trainparser.add_argument(
+        "--states",
+        type=int,
+        default=3,
+        help="number of hidden states of each user's model (default: 3)")
+    trainparser.add_argument(
+        "--restarts",
+        type=int,
+        default=1,
+        help="number of random initializations to fit per user, keeping "
+        "the most likely (default: 1)")
+    trainparser.add_argument(
+        "--iterations",
+        type=int,
+        default=10,
+        help="largest number of EM iterations per fit (default: 10)")
+    trainparser.add_argument(
+        "--seed",
+        type=int,
+        help="seed for the random initializations")
+    trainparser.add_argument(
+        "--workers", "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes (default: number of CPUs)")
+    trainparser.add_argument(
+        "--verbose", "-v",
+        action="store_true",
+        help="report progress, per-user fits and per-stage timings")
     trainparser.set_defaults(func=_train_model)
 
     predictparser = subparsers.add_parser("predict", help="predict typer")
@@ -0,0 +1,196 @@
+"""
+Opt-in timing and counting of the identifiers' per-keystroke work
+
+KDIdentifier, TyperOracle and HmmOracle derive from Instrumented.  Until
+enable_instrumentation is called their instruments attribute is None, and the
+only cost on the hot path is a handful of "is not None" checks.  Once
+enabled, every keystroke records the time spent in each stage of its
+processing into a LatencyHistogram, and counts events such as key pairs
+skipped because some identity lacked them, or densities evaluated.  stats()
+returns a snapshot, which can also be written to a file periodically.
+Instruments take no locks, so stats() must be called from the thread stepping
+the model (as keydetect's OracleWorker does), or while nothing steps it.
+"""
+import json
+import math
+import os
+import time
+
+# the clock used for every timing
+clock = time.perf_counter
+
+# latency histograms have this many buckets per doubling, from 1ns
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 40 * BUCKETS_PER_OCTAVE
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed histogram of durations, with exact count, total and maximum
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        records one duration, in seconds
+        """
+        nanoseconds = seconds * 1e9
+        index = 0
+        if nanoseconds > 1.0:
+            index = min(int(math.log2(nanoseconds) * BUCKETS_PER_OCTAVE),
+                        NUM_BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        returns an upper bound of the duration at fraction q (0 to 1) of the
+        ranked durations, within one bucket (about 19%)
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative > 0:
+                break
+        upper = 2.0 ** ((index + 1) / BUCKETS_PER_OCTAVE) / 1e9
+        return min(upper, self.max)
+
+    def summary(self):
+        """
+        returns a dictionary of the count and total of the durations, and
+        their mean, median, 90th and 99th percentiles and maximum in
+        microseconds
+        """
+        mean = self.total / self.count if self.count else math.nan
+        return {"count": self.count,
+                "total_seconds": self.total,
+                "mean_us": mean * 1e6,
+                "p50_us": self.quantile(0.5) * 1e6,
+                "p90_us": self.quantile(0.9) * 1e6,
+                "p99_us": self.quantile(0.99) * 1e6,
+                "max_us": self.max * 1e6}
+
+
+class Instruments:
+    """
+    Stage timings and event counters of one model
+    """
+
+    def __init__(self, name, dump_path=None, dump_interval=60.0):
+        """
+         * name labels the model in stats
+         * dump_path, if given, is a file that stats are written to every
+           dump_interval seconds, as JSON
+        """
+        self.name = name
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.reset()
+
+    def reset(self):
+        """
+        forgets everything recorded so far
+        """
+        self.counters = {}
+        self.stages = {}
+        self.since = time.time()
+        self._last_dump = clock()
+
+    def count(self, counter, amount=1):
+        """
+        adds amount to the counter called counter
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def record(self, stage, seconds):
+        """
+        records that the stage called stage took seconds
+        """
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram()
+        histogram.add(seconds)
+
+    def tick(self):
+        """
+        marks the end of a keystroke, and dumps stats if one is due
+        """
+        if self.dump_path is not None and \
+                clock() - self._last_dump >= self.dump_interval:
+            self.dump()
+
+    def stats(self):
+        """
+        returns a dictionary of the name, the time recording started, the
+        counters, and a summary of each stage's timings
+        """
+        return {"name": self.name,
+                "since": self.since,
+                "counters": dict(sorted(self.counters.items())),
+                "stages": {stage: histogram.summary() for stage, histogram
+                           in sorted(self.stages.items())}}
+
+    def dump(self, path=None):
+        """
+        writes stats to path, dump_path by default, as JSON
+        """
+        path = path or self.dump_path
+        self._last_dump = clock()
+        write_json(path, self.stats())
+
+
+class Instrumented:
+    """
+    Gives a model opt-in Instruments; instruments is None while disabled
+    """
+    instruments = None
+
+    def enable_instrumentation(self, dump_path=None, dump_interval=60.0):
+        """
+        starts recording stage timings and counters
+         * dump_path, if given, is a file that stats are written to every
+           dump_interval seconds, as JSON
+
+        returns the Instruments
+        """
+        self.instruments = Instruments(type(self).__name__, dump_path,
+                                       dump_interval)
+        return self.instruments
+
+    def disable_instrumentation(self):
+        """
+        stops recording
+        """
+        self.instruments = None
+
+    def stats(self):
+        """
+        returns a snapshot of what has been recorded since instrumentation was
+        enabled, as from Instruments.stats, or an empty dictionary while it is
+        disabled
+        """
+        if self.instruments is None:
+            return {}
+        return self.instruments.stats()
+
+
+def write_json(path, data):
+    """
+    writes data to path as JSON, replacing the file atomically
+    """
+    tmppath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmppath, "w") as ofh:
+        json.dump(data, ofh, indent=1, allow_nan=True)
+    os.replace(tmppath, path)
@@ -1,4 +1,6 @@
 import numpy
+import kd_pairs
+from kd_sketch import QuantileSketch, summarize
 
 class ItoATools:
     non_char_chars = \
@@ -58,62 +60,51 @@ class ItoATools:
 
 class KDAnalyzer:
 
-    def __init__(self,filenames,time_interval_threshold=1.0,num_top_pairs=10,freq_level=10,default_pairs="all",id_name="none"):
-        self.loadfile(filenames,time_interval_threshold,num_top_pairs,freq_level,default_pairs,id_name)
+    # sketch_k: If given, each pair keeps a kd_sketch.QuantileSketch of this size instead of
+    #           every raw interval, so memory stays bounded however much data is loaded.
+    #           Quantiles are then approximate (the rank error shrinks roughly as 1/sketch_k);
+    #           count, min, max, mean and standard deviation stay exact.
+    def __init__(self,filenames,time_interval_threshold=1.0,num_top_pairs=10,freq_level=10,default_pairs="all",id_name="none",sketch_k=None):
+        self.loadfile(filenames,time_interval_threshold,num_top_pairs,freq_level,default_pairs,id_name,sketch_k)
         return
 
-    def loadfile(self,filenames,time_interval_threshold,num_top_pairs,freq_level,default_pairs,id_name):
+    def loadfile(self,filenames,time_interval_threshold,num_top_pairs,freq_level,default_pairs,id_name,sketch_k=None):
         self.filenames = filenames
         self.time_interval_threshold = time_interval_threshold
-        data_list = []
-        for filename in filenames:
-            data = numpy.loadtxt(filename)
-            data_list.append(data)
-        self.data = data_list[0]
-        for i in range(1,len(data_list)):
-            self.data = numpy.concatenate((self.data,data_list[i]),axis=0)
-        self.data = data
-        self.asciicodes = data[:,0].astype(numpy.int64)
-        self.timestamps = data[:,1]
         self.id_name = id_name
+        self.sketch_k = sketch_k
 
         # Building dictionary of key-strike pairs; ignoring pairs with interval greater
-        # than 1 second
-        pairs = dict()
-        for i in range(0,len(self.asciicodes)-1):
-            key = tuple((self.asciicodes[i],self.asciicodes[i+1]))
-            time_interval = numpy.abs(self.timestamps[i+1]-self.timestamps[i])
-            if(time_interval < self.time_interval_threshold):
-                if not(key in pairs):
-                    pairs[key] = []
-                pairs[key].append(time_interval)
-
-        self.pairs = pairs
-
-        #Building "freq_pairs": The pairs that were encountered more than "freq_level" times
-        freq_pairs_list = []
-        for pair in self.pairs:
-            if( len(self.pairs[pair]) >= 15 ):
-                freq_pairs_list.append((pair,self.pairs[pair]))
-        self.freq_pairs = dict(freq_pairs_list)
-
-        #Building "top_pairs":  The ten pairs most frequently encountered in the data
-        top_pairs_list = []
-        top_count = 0
-        for pair in self.pairs:
-            top_pairs_list.append((pair,self.pairs[pair]))
-            if( len(top_pairs_list) > num_top_pairs ):
-                #remove the item with the lowest count
-                lowest_count = numpy.iinfo(numpy.int64).max
-                found_index = 0
-                for i in range(0,len(top_pairs_list)):
-                    item = top_pairs_list[i]
-                    if(len(item[1]) < lowest_count):
-                        lowest_count = len(item[1])
-                        found_index = i
-                top_pairs_list.pop(found_index)
-
-        self.top_pairs = dict(top_pairs_list)
+        # than 1 second.
+        if(sketch_k is None):
+            # The timings of each pair are views into one contiguous array (see kd_pairs).
+            self.groups = kd_pairs.group_files(filenames,self.time_interval_threshold)
+            self.pairs = self.groups.to_dict()
+            self.pair_codes = self.groups.codes
+            self.pair_counts = self.groups.counts()
+        else:
+            # Sketching one file at a time, so the raw intervals of only one file are
+            # held at once
+            self.groups = None
+            sketches = dict()
+            for filename in filenames:
+                groups = kd_pairs.group_files([filename],self.time_interval_threshold)
+                for i,code in enumerate(groups.codes):
+                    if not(code in sketches):
+                        sketches[code] = QuantileSketch(sketch_k,seed=int(code))
+                    sketches[code].extend(groups.group(i))
+            self.pair_codes = numpy.array(sorted(sketches),dtype=numpy.int64)
+            self.pair_counts = numpy.array([sketches[code].count for code in self.pair_codes],dtype=numpy.int64)
+            self.pairs = dict()
+            for code in self.pair_codes:
+                self.pairs[kd_pairs.pair_key(code)] = sketches[code]
+
+        # "freq_pairs" and "top_pairs" are selected from the pair counts the first time
+        # they are needed
+        self.freq_level = freq_level
+        self.num_top_pairs = num_top_pairs
+        self._freq_pairs = None
+        self._top_pairs = None
 
         #Specific Pairs list
         specific_pairs_list = [(100,32), (114,32), (101,32), (116,104), (104,97), (114,101), (32,116), (104,101), (97,116), (116,32)]
@@ -121,15 +112,52 @@ class KDAnalyzer:
         for pair in specific_pairs_list:
             self.specific_pairs[pair] = self.pairs[pair]
 
-        if(default_pairs == "all"):
-            self.default_pairs = self.pairs
-        elif(default_pairs == "top"):
-            self.default_pairs = self.top_pairs
-        elif(default_pairs == "specific"):
-            self.default_pairs = self.specific_pairs
+        self.default_pairs_kind = default_pairs
 
         return
 
+    # "freq_pairs": The pairs that were encountered at least "freq_level" times
+    @property
+    def freq_pairs(self):
+        if(self._freq_pairs is None):
+            counts = self.pair_counts
+            self._freq_pairs = self._select_pairs(numpy.nonzero(counts >= self.freq_level)[0])
+        return self._freq_pairs
+
+    # "top_pairs": The "num_top_pairs" pairs most frequently encountered in the data,
+    # most frequent first
+    @property
+    def top_pairs(self):
+        if(self._top_pairs is None):
+            counts = self.pair_counts
+            num_top = min(self.num_top_pairs,len(counts))
+            if(num_top < len(counts)):
+                # Partial selection; only the chosen few are sorted
+                indices = numpy.argpartition(-counts,num_top-1)[:num_top]
+            else:
+                indices = numpy.arange(len(counts))
+            indices = indices[numpy.argsort(-counts[indices],kind="stable")]
+            self._top_pairs = self._select_pairs(indices)
+        return self._top_pairs
+
+    @property
+    def default_pairs(self):
+        if(self.default_pairs_kind == "all"):
+            return self.pairs
+        elif(self.default_pairs_kind == "top"):
+            return self.top_pairs
+        elif(self.default_pairs_kind == "specific"):
+            return self.specific_pairs
+
+    def _select_pairs(self,indices):
+        # Builds a dictionary of pair: timings (or sketch) for the pairs at the given
+        # positions in self.pair_codes
+        selected = dict()
+        for i in indices:
+            pair = kd_pairs.pair_key(self.pair_codes[i])
+            selected[pair] = self.pairs[pair]
+        return selected
+
     def printPairs(self):
         pairs=self.default_pairs
         for pair in pairs:
@@ -139,15 +167,14 @@ class KDAnalyzer:
         # Printing the pairs, but only if the count threshold is high enough.
         pairs=self.default_pairs
         for pair in pairs:
-            times_arr = numpy.array(pairs[pair])
-            count = len(times_arr)
-            average_time_interval = times_arr.sum()/count
+            # Works on raw intervals and on sketches alike
+            count,average_time_interval,min_time,max_time,std_time = summarize(pairs[pair])
             print("Pair: ",ItoATools.intTupleToCharTupleLong(pair),
                   " Count: ",count,
                   " Average Time Interval: ",average_time_interval,
-                  " Min: ", numpy.min(pairs[pair]),
-                  " Max: ", numpy.max(pairs[pair]),
-                  " Standard Deviation: ",numpy.std(pairs[pair]))
+                  " Min: ", min_time,
+                  " Max: ", max_time,
+                  " Standard Deviation: ",std_time)
 
     def plotBoxPlot(self):
         import matplotlib
@@ -161,7 +188,11 @@ class KDAnalyzer:
             xlabels.append(ItoATools.intTupleToCharTuple(pair))
         fig = pyplot.figure(figsize=(9, 6))
         ax = fig.add_subplot(111)
-        bp = ax.boxplot(data_to_plot)
+        if(self.sketch_k is None):
+            bp = ax.boxplot(data_to_plot)
+        else:
+            # Sketches give the box statistics directly; outliers are not kept
+            bp = ax.bxp([sketch.boxplot_stats() for sketch in data_to_plot])
         pyplot.title(self.filenames[0])
         ax.set_xticklabels(xlabels)
         pyplot.ylim((0,self.time_interval_threshold))
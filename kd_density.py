@@ -0,0 +1,283 @@
+"""
+Grid-interpolated kernel density tables
+
+Instead of one sklearn KernelDensity per (user, key-pair), which keeps its
+whole training sample and a ball tree and pays Python and tree-query overhead
+on every score call, GridDensities evaluates every Gaussian KDE once on a
+fixed grid of timings and keeps the log-densities in a single float32 array
+of shape (users, key-pairs, grid points).  Scoring a timing is then a
+vectorized linear interpolation.
+
+The KDEs are evaluated with a binned FFT convolution: training timings are
+linearly binned onto the grid (extended by four bandwidths on each side) and
+convolved with the kernel.  Timings beyond the extended grid are added in
+exactly.  The training timings and bandwidth are kept too, so that queries
+outside the grid, such as pauses, are scored exactly from them rather than
+from the grid's ends; densities built without them (TyperOracles saved before
+version 2) clamp such queries to the ends of the grid.
+
+The tables also make it cheap to rank key-pairs by how well they tell users
+apart: separability compares every pair of users' densities for every
+key-pair at once.
+"""
+import numpy as np
+
+DEFAULT_BANDWIDTH = 1.0
+DEFAULT_GRID_MAX = 1.2
+DEFAULT_GRID_STEP = 0.001
+
+# rows of the binned histogram convolved at once, to bound memory
+_CHUNK_ROWS = 32
+
+
+def _gaussian(x, bandwidth):
+    """
+    returns the Gaussian kernel with the given bandwidth at x
+    """
+    return np.exp(-0.5 * (x / bandwidth) ** 2) / \
+        (bandwidth * np.sqrt(2 * np.pi))
+
+
+def kde_on_grid(samples_list, grid, bandwidth):
+    """
+     * samples_list is a list of arrays of training timings, one per KDE
+     * grid is an evenly spaced array of timings
+     * bandwidth is the bandwidth of the Gaussian kernel
+
+    returns an array of shape (len(samples_list), len(grid)) with the density
+    of each KDE at each grid point
+    """
+    step = grid[1] - grid[0]
+    pad = int(np.ceil(4 * bandwidth / step))
+    size = len(grid) + 2 * pad
+    start = grid[0] - pad * step
+    # the kernel at every offset between two points of the extended grid
+    offsets = np.arange(-(size - 1), size) * step
+    kernel = _gaussian(offsets, bandwidth)
+    nfft = 1 << int(np.ceil(np.log2(size + len(kernel) - 1)))
+    kernel_fft = np.fft.rfft(kernel, nfft)
+
+    result = np.zeros((len(samples_list), len(grid)))
+    for first in range(0, len(samples_list), _CHUNK_ROWS):
+        chunk = samples_list[first:first + _CHUNK_ROWS]
+        hist = np.zeros((len(chunk), size))
+        for row, samples in enumerate(chunk):
+            samples = np.asarray(samples, dtype=np.float64)
+            position = (samples - start) / step
+            inside = (position >= 0) & (position < size - 1)
+            position = position[inside]
+            lower = np.floor(position).astype(np.int64)
+            frac = position - lower
+            hist[row] = np.bincount(lower, weights=1 - frac, minlength=size) + \
+                np.bincount(lower + 1, weights=frac, minlength=size)
+            outside = samples[~inside]
+            if len(outside):
+                result[first + row] += _gaussian(
+                    grid[:, None] - outside[None, :], bandwidth).sum(axis=1)
+        convolved = np.fft.irfft(np.fft.rfft(hist, nfft) * kernel_fft, nfft)
+        # convolved[size - 1 + i] is the density at extended grid point i
+        result[first:first + len(chunk)] += \
+            convolved[:, size - 1 + pad:size - 1 + pad + len(grid)]
+    counts = np.array([len(samples) for samples in samples_list])
+    return result / np.maximum(counts, 1)[:, None]
+
+
+def pack_samples(samples_list):
+    """
+     * samples_list is a list of arrays of training timings, one per KDE
+
+    returns (samples, offsets): the timings concatenated into one array, and
+    an array of the position where each KDE's timings start, followed by the
+    total number of timings
+    """
+    samples_list = [np.asarray(samples, dtype=np.float64).ravel()
+                    for samples in samples_list]
+    offsets = np.concatenate(
+        ([0], np.cumsum([len(samples) for samples in samples_list])))
+    samples = np.concatenate(samples_list) if samples_list else np.empty(0)
+    return samples, offsets.astype(np.int64)
+
+
+def exact_logpdf(samples, timings, bandwidth):
+    """
+     * samples is an array of the training timings of one KDE
+     * timings is an array of timings
+     * bandwidth is the bandwidth of the Gaussian kernel
+
+    returns an array of the log-density of each timing under the KDE,
+    computed without underflow however far timings are from samples
+    """
+    if len(samples) == 0:
+        return np.full(len(timings), np.log(np.finfo(np.float64).tiny))
+    exponents = -0.5 * ((np.asarray(timings)[:, None] -
+                         np.asarray(samples)[None, :]) / bandwidth) ** 2
+    largest = exponents.max(axis=1)
+    return largest + np.log(np.exp(exponents - largest[:, None]).sum(axis=1)) \
+        - np.log(len(samples) * bandwidth * np.sqrt(2 * np.pi))
+
+
+class GridDensities:
+    """
+    Log-densities of every (user, key-pair) KDE on a fixed grid of timings
+    """
+
+    def __init__(self, grid_start, grid_step, table, samples=None,
+                 offsets=None, bandwidth=None):
+        """
+         * grid_start is the timing of the first grid point
+         * grid_step is the spacing of the grid
+         * table must be an array of shape (users, key-pairs, grid points) of
+           log-densities
+         * samples, offsets and bandwidth, if given, are the training timings
+           of every KDE, in the same order as the table's rows, as from
+           pack_samples, and the bandwidth of the kernels; timings outside
+           the grid are then scored exactly, and otherwise clamped to it
+        """
+        self.grid_start = float(grid_start)
+        self.grid_step = float(grid_step)
+        self.table = table
+        self.samples = samples
+        self.offsets = offsets
+        self.bandwidth = None if bandwidth is None else float(bandwidth)
+
+    def __setstate__(self, state):
+        # densities pickled before the training timings were kept
+        state.setdefault("samples", None)
+        state.setdefault("offsets", None)
+        state.setdefault("bandwidth", None)
+        self.__dict__.update(state)
+
+    @classmethod
+    def fit(cls, userlist, keypairlist, labeledtimelists,
+            bandwidth=DEFAULT_BANDWIDTH, grid_max=DEFAULT_GRID_MAX,
+            grid_step=DEFAULT_GRID_STEP):
+        """
+         * userlist is a list of users
+         * keypairlist is a list of key-pairs every user has timings for
+         * labeledtimelists is a dictionary of label: {keypair: [timing]}
+         * bandwidth is the bandwidth of the Gaussian kernels
+         * grid_max is the largest timing on the grid, which starts at 0
+         * grid_step is the spacing of the grid
+
+        returns a GridDensities
+        """
+        grid = np.arange(int(round(grid_max / grid_step)) + 1) * grid_step
+        samples_list = [labeledtimelists[user][keypair]
+                        for user in userlist for keypair in keypairlist]
+        densities = kde_on_grid(samples_list, grid, bandwidth)
+        tiny = np.finfo(np.float64).tiny
+        table = np.log(np.maximum(densities, tiny)).astype(np.float32)
+        samples, offsets = pack_samples(samples_list)
+        return cls(0.0, grid_step, table.reshape(
+            len(userlist), len(keypairlist), len(grid)), samples, offsets,
+            bandwidth)
+
+    def _positions(self, timings):
+        """
+        returns the grid cell and the fraction within it of each timing
+        """
+        position = (np.asarray(timings, dtype=np.float64) - self.grid_start) \
+            / self.grid_step
+        position = np.clip(position, 0, self.table.shape[2] - 1)
+        lower = np.minimum(position.astype(np.int64), self.table.shape[2] - 2)
+        return lower, position - lower
+
+    def _outside(self, timings):
+        """
+        returns a boolean array of which timings lie outside the grid and
+        can be scored exactly, or None when none of them do
+        """
+        if self.samples is None:
+            return None
+        grid_end = self.grid_start + (self.table.shape[2] - 1) * self.grid_step
+        outside = (timings < self.grid_start) | (timings > grid_end)
+        return outside if outside.any() else None
+
+    def _exact(self, index, timings):
+        """
+        returns an array of shape (users, timings) with the exact log-density
+        of each timing under each user's KDE for the key-pair at index
+        """
+        num_keypairs = self.table.shape[1]
+        result = np.empty((self.table.shape[0], len(timings)))
+        for user in range(self.table.shape[0]):
+            row = user * num_keypairs + index
+            result[user] = exact_logpdf(
+                self.samples[self.offsets[row]:self.offsets[row + 1]],
+                timings, self.bandwidth)
+        return result
+
+    def logpdf(self, index, timing):
+        """
+         * index is the position of a key-pair in the keypairlist
+         * timing is a timing
+
+        returns an array with the log-density of timing under each user's KDE
+        """
+        if self._outside(np.array([timing], dtype=np.float64)) is not None:
+            return self._exact(index, [timing])[:, 0]
+        lower, frac = self._positions(timing)
+        values = self.table[:, index, lower:lower + 2]
+        return values[:, 0] + (values[:, 1] - values[:, 0]) * frac
+
+    def score(self, index, timings):
+        """
+         * index is the position of a key-pair in the keypairlist
+         * timings is an array of timings
+
+        returns an array with the total log-density of timings under each
+        user's KDE, like KernelDensity.score
+        """
+        timings = np.ravel(np.asarray(timings, dtype=np.float64))
+        outside = self._outside(timings)
+        total = 0.0
+        if outside is not None:
+            total = self._exact(index, timings[outside]).sum(axis=1)
+            timings = timings[~outside]
+        lower, frac = self._positions(timings)
+        values = self.table[:, index]
+        return total + (values[:, lower] * (1 - frac) +
+                        values[:, lower + 1] * frac).sum(axis=1)
+
+    def separability(self):
+        """
+        returns an array with, for each key-pair, the mean Bhattacharyya
+        distance between the densities of every pair of users, each
+        normalized over the grid; key-pairs whose timings tell users apart
+        score higher, and with fewer than two users every score is 0
+        """
+        num_users, num_keypairs, _ = self.table.shape
+        result = np.zeros(num_keypairs)
+        if num_users < 2:
+            return result
+        first_users, second_users = np.triu_indices(num_users, 1)
+        for first in range(0, num_keypairs, _CHUNK_ROWS):
+            logp = np.asarray(self.table[:, first:first + _CHUNK_ROWS],
+                              dtype=np.float64).transpose(1, 0, 2)
+            density = np.exp(logp - logp.max(axis=2, keepdims=True))
+            root = np.sqrt(density / density.sum(axis=2, keepdims=True))
+            # coefficients[k, u, v] is the Bhattacharyya coefficient of users
+            # u and v for the k-th key-pair of the chunk
+            coefficients = np.matmul(root, root.transpose(0, 2, 1))
+            distances = -np.log(np.clip(coefficients, np.finfo(float).tiny, 1))
+            result[first:first + len(root)] = \
+                distances[:, first_users, second_users].mean(axis=1)
+        return result
+
+    def select(self, indices):
+        """
+         * indices is an array of positions of key-pairs to keep
+
+        returns a GridDensities for only those key-pairs, in that order
+        """
+        table = np.ascontiguousarray(self.table[:, indices])
+        if self.samples is None:
+            return GridDensities(self.grid_start, self.grid_step, table)
+        num_users, num_keypairs = self.table.shape[:2]
+        rows = [user * num_keypairs + index for user in range(num_users)
+                for index in indices]
+        samples, offsets = pack_samples(
+            [self.samples[self.offsets[row]:self.offsets[row + 1]]
+             for row in rows])
+        return GridDensities(self.grid_start, self.grid_step, table, samples,
+                             offsets, self.bandwidth)
@@ -17,9 +17,15 @@ This is the idea:
     (ii) Print the three probabilities to the screen, identifying the highest probability.
 """
 
-from kd_analyze import KDAnalyzer
-from kd_analyze import ItoATools
+import hashlib
+import json
+import os
 import numpy
+import kd_pairs
+import kd_store
+import kd_stats
+from kd_stats import PairStats
+from instrumentation import Instrumented, clock
 
 # *** find_max ***
 # Finds the maximum value in the dictionary, and the key of it.
@@ -42,8 +48,90 @@ def find_max(d):
 def normal_pdf(std,mean,x):
     return (1/(std*numpy.sqrt(2*numpy.pi))) * numpy.exp(-((x - mean)**2/(2*std**2)))
 
+# Columns of the per-pair parameter tables
+MEAN, STD, LOG_MEAN, LOG_STD, PRESENT = range(5)
+
+# Identifies saved KDIdentifier snapshots, and the version of their layout
+SNAPSHOT_KIND = "kd_identifier"
+SNAPSHOT_VERSION = 1
+
+# *** build_param_matrix ***
+# Computes the normal and log-normal parameters of the frequent key-pairs of every identity.
+# stats_list: A list of kd_stats.PairStats, one for each identity
+# freq_level: The minimum frequency of a key-pair event, before that set of events is considered.
+# Returns: pair_columns, an array indexed by packed key-pair code giving the column of that
+#          pair (-1 if no identity has it), and params, an array of shape
+#          (identities, pairs, 5) with the columns MEAN, STD, LOG_MEAN, LOG_STD and PRESENT.
+def build_param_matrix(stats_list,freq_level):
+    frequent = numpy.array([stats.count >= freq_level for stats in stats_list]).reshape(
+        len(stats_list),kd_pairs.NUM_PAIR_CODES)
+    codes = numpy.nonzero(numpy.any(frequent,axis=0))[0]
+    pair_columns = numpy.full(kd_pairs.NUM_PAIR_CODES,-1,dtype=numpy.int64)
+    pair_columns[codes] = numpy.arange(len(codes))
+
+    params = numpy.zeros((len(stats_list),len(codes),5))
+    for i,stats in enumerate(stats_list):
+        present = frequent[i,codes]
+        params[i,:,MEAN] = stats.mean[codes]
+        params[i,:,STD] = stats.std()[codes]
+        params[i,:,LOG_MEAN] = stats.log_mean[codes]
+        params[i,:,LOG_STD] = stats.log_std()[codes]
+        params[i,:,PRESENT] = present
+        params[i,~present,:] = 0.0
+    return pair_columns,params
+
+
+# *** snapshot_key ***
+# Identifies a trained KDIdentifier by its inputs, for KDIdentifier.cached.
+# id_names_files: A dictionary of identity name: list of file paths
+# The other arguments are the parameters of KDIdentifier that change the trained model.
+# Returns: A hex digest of the identities, in order, the paths, modification times and sizes
+#          of their files, and the parameters.
+def snapshot_key(id_names_files,time_interval_threshold,freq_level,use_log_norm_pdf):
+    inputs = []
+    for id in id_names_files:
+        files = []
+        for filename in id_names_files[id]:
+            status = os.stat(filename)
+            files.append([os.path.abspath(filename),status.st_mtime_ns,status.st_size])
+        inputs.append([id,files])
+    key = json.dumps({"version": SNAPSHOT_VERSION,
+                      "inputs": inputs,
+                      "time_interval_threshold": time_interval_threshold,
+                      "freq_level": freq_level,
+                      "use_log_norm_pdf": use_log_norm_pdf})
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class KDSession:
+
+    # *** KDSession init ***
+    # The live state of one typist being identified by a shared KDIdentifier.
+    # num_ids: The number of known identities
+    # history_length: The length of the history of events to rely on to compute the guess.
+    __slots__ = ("history","history_pos","history_sums","prev_ascii","prev_timestamp","guess")
+
+    def __init__(self,num_ids,history_length):
+        # Ring buffer of the encountered probabilities, one row for each id candidate,
+        # along with the running sum of each row
+        self.history = numpy.zeros((num_ids,history_length))
+        self.history_pos = 0
+        self.history_sums = numpy.zeros(num_ids)
+
+        # Used to keep track of previous keystroke.
+        self.prev_ascii = -1
+        self.prev_timestamp = -1.
+
+        # The current guess
+        self.guess = "<none>"
 
-class KDIdentifier:
+
+class KDIdentifier(Instrumented):
+
+    # The trained model only changes through enroll, so one identifier can serve many
+    # typists at once, each with its own KDSession (see sessions).  processKeystroke
+    # uses a default session of the identifier's own.  enable_instrumentation records
+    # the time of each stage of step, and stats() returns it (see instrumentation).
 
     # *** KDIdentifier init ***
     # id_names_files:  A dictionary, the each key is the known identity name, and each value
@@ -59,48 +147,201 @@ class KDIdentifier:
                 history_length=100,
                 use_log_norm_pdf=False):
 
-        self.id_names_files = id_names_files
+        self.id_names_files = dict()
+        self.time_interval_threshold = time_interval_threshold
+        self.freq_level = freq_level
+        self.history_length = history_length
 
         # Whether to take the norm pdf of original data
         # or to take the norm pdf of log(data)
         self.use_log_norm_pdf = use_log_norm_pdf
 
-        # Assembling the learned identities
-        self.known_ids = dict()
-        for id in id_names_files:
-            self.known_ids[id] = KDAnalyzer(self.id_names_files[id],
-                                            time_interval_threshold=time_interval_threshold,
-                                            freq_level=freq_level,
-                                            id_name=id)
-
-        # Create a list for each id candidate, to save the list of encountered probabilities
-        self.probab_histories = dict()
+        # Assembling the learned identities from their mergeable key-pair statistics
+        self.id_list = []
+        self.pair_stats = dict()
+        self._known_ids = None
         for id in id_names_files:
-            self.probab_histories[id] = numpy.zeros(history_length).tolist()
-
-        # Used to see if all the known ids have the desired key-pair
-        self.success_bool = dict()
-        for id in self.known_ids:
-            self.success_bool[id] = False
-
-        # Used to collect the probabilities from each known_id
-        self.probs = dict()
-        for id in self.known_ids:
-            self.probs[id] = 0.0
-
-        # Used to store the summation of all the probabilities so far, so we can get the maximum
-        self.prob_sums = dict()
-        for id in self.known_ids:
-            self.prob_sums[id] = 0.0
-
-        # Used to keep track of previous and current keystrokes.
-        self.prev_ascii = -1
-        self.prev_timestamp = -1.
-        self.curr_ascii = -1
-        self.curr_timestamp = -1.
-
-        # The current guess
-        self.guess = "<none>"
+            self.id_names_files[id] = list(id_names_files[id])
+            self.id_list.append(id)
+            self.pair_stats[id] = PairStats.from_files(id_names_files[id],time_interval_threshold)
+        self._build_model()
+        self.session = self.new_session()
+
+
+    # *** cached ***
+    # Returns an identifier for id_names_files from a snapshot cache, building and saving it
+    # only when no snapshot matches the files (by path, modification time and size) and the
+    # parameters.
+    # id_names_files: As for __init__
+    # cache_dir: The directory of snapshots, kd_store.CACHE_DIR by default
+    # history_length: As for __init__; it does not change the snapshot
+    # The other arguments are as for __init__.
+    @classmethod
+    def cached(cls,
+               id_names_files,
+               cache_dir=None,
+               time_interval_threshold=1.2,
+               freq_level=10,
+               history_length=100,
+               use_log_norm_pdf=False):
+        key = snapshot_key(id_names_files,time_interval_threshold,freq_level,use_log_norm_pdf)
+        path = os.path.join(cache_dir or kd_store.CACHE_DIR,"kdidentifier-"+key+kd_store.EXTENSION)
+        if(os.path.exists(path)):
+            return cls.load(path,history_length)
+        identifier = cls(id_names_files,time_interval_threshold,freq_level,history_length,
+                         use_log_norm_pdf)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        identifier.save(path)
+        return identifier
+
+
+    # *** save ***
+    # Writes a snapshot of the identifier, its parameters and the key-pair statistics of
+    # every identity, to a kd_store file that load reads without touching any keystroke file.
+    # path: The name of the file to write
+    def save(self,path):
+        counts = numpy.array([self.pair_stats[id].count for id in self.id_list]).reshape(
+            len(self.id_list),kd_pairs.NUM_PAIR_CODES)
+        codes = numpy.nonzero(numpy.any(counts > 0,axis=0))[0]
+        columns = {"codes": codes}
+        for field in kd_stats.FIELDS:
+            columns[field] = numpy.array([getattr(self.pair_stats[id],field)[codes]
+                                          for id in self.id_list]).reshape(len(self.id_list),len(codes))
+        kd_store.write_columns(path,columns,{"kind": SNAPSHOT_KIND,
+                                             "version": SNAPSHOT_VERSION,
+                                             "id_list": self.id_list,
+                                             "id_names_files": self.id_names_files,
+                                             "time_interval_threshold": self.time_interval_threshold,
+                                             "freq_level": self.freq_level,
+                                             "history_length": self.history_length,
+                                             "use_log_norm_pdf": self.use_log_norm_pdf})
+
+
+    # *** load ***
+    # path: The name of a file written by save
+    # history_length: If given, overrides the history length saved with the snapshot
+    # Returns: The KDIdentifier saved to path.
+    @classmethod
+    def load(cls,path,history_length=None):
+        meta,columns = kd_store.read_columns(path)
+        if(meta.get("kind") != SNAPSHOT_KIND):
+            raise ValueError("%s does not hold a KDIdentifier snapshot" % path)
+        if(meta.get("version",0) > SNAPSHOT_VERSION):
+            raise ValueError("%s was saved by a newer version (%r)" % (path,meta["version"]))
+        if(history_length is None):
+            history_length = meta["history_length"]
+        identifier = cls(dict(),meta["time_interval_threshold"],meta["freq_level"],
+                         history_length,meta["use_log_norm_pdf"])
+        codes = columns["codes"]
+        for i,id in enumerate(meta["id_list"]):
+            stats = PairStats(meta["time_interval_threshold"])
+            for field in kd_stats.FIELDS:
+                getattr(stats,field)[codes] = columns[field][i]
+            identifier.pair_stats[id] = stats
+            identifier.id_names_files[id] = list(meta["id_names_files"][id])
+            identifier.id_list.append(id)
+        identifier._build_model()
+        identifier.session = identifier.new_session()
+        return identifier
+
+
+    # *** _build_model ***
+    # Precomputes the density parameters of every key-pair for all identities at once,
+    # so scoring a keystroke is one table lookup and one vectorized pdf evaluation.
+    def _build_model(self):
+        self.pair_columns,self.params = build_param_matrix([self.pair_stats[id] for id in self.id_list],
+                                                           self.freq_level)
+        if(self.use_log_norm_pdf):
+            self.pdf_means = numpy.ascontiguousarray(self.params[:,:,LOG_MEAN])
+            self.pdf_stds = numpy.ascontiguousarray(self.params[:,:,LOG_STD])
+        else:
+            self.pdf_means = numpy.ascontiguousarray(self.params[:,:,MEAN])
+            self.pdf_stds = numpy.ascontiguousarray(self.params[:,:,STD])
+        # we only use a pair if all of the ids had it
+        self.present_in_all = numpy.all(self.params[:,:,PRESENT] > 0,axis=0)
+
+
+    # *** known_ids ***
+    # Returns: A dictionary with the KDAnalyzer of each known identity, built on first use.
+    #          Identities enrolled only through statistics, with no files, have no analyzer.
+    @property
+    def known_ids(self):
+        if(self._known_ids is None):
+            # kd_analyze is only needed here, so it is imported on first use
+            from kd_analyze import KDAnalyzer
+            self._known_ids = dict()
+            for id in self.id_list:
+                if(not self.id_names_files[id]):
+                    continue
+                self._known_ids[id] = KDAnalyzer(self.id_names_files[id],
+                                                 time_interval_threshold=self.time_interval_threshold,
+                                                 freq_level=self.freq_level,
+                                                 id_name=id)
+        return self._known_ids
+
+
+    # *** enroll ***
+    # Adds recordings to a known identity, or adds a new identity.  Only the new recordings
+    # are read.  Sessions opened before a new identity is added must be replaced with
+    # new_session; the default session is replaced here.
+    # id: The identity name
+    # filenames: The list of file paths of the new data
+    def enroll(self,id,filenames):
+        stats = PairStats.from_files(filenames,self.time_interval_threshold)
+        self.enroll_stats(id,stats,filenames)
+
+
+    # *** enroll_stats ***
+    # Same as enroll, for statistics computed elsewhere (for example on another machine).
+    # id: The identity name
+    # stats: The kd_stats.PairStats of the new data
+    # filenames: The list of file paths the statistics came from, if known
+    def enroll_stats(self,id,stats,filenames=()):
+        if(stats.time_interval_threshold != self.time_interval_threshold):
+            raise ValueError("cannot merge statistics with different time "
+                             "interval thresholds (%r and %r)" %
+                             (self.time_interval_threshold,
+                              stats.time_interval_threshold))
+        if(id in self.pair_stats):
+            self.pair_stats[id].merge(stats)
+            self.id_names_files[id].extend(filenames)
+        else:
+            self.pair_stats[id] = stats.copy()
+            self.id_names_files[id] = list(filenames)
+            self.id_list.append(id)
+            self.session = self.new_session()
+        self._known_ids = None
+        self._build_model()
+
+
+    # *** new_session ***
+    # Returns: A KDSession for a new typist.
+    def new_session(self):
+        return KDSession(len(self.id_list),self.history_length)
+
+
+    # *** guess ***
+    # Returns: The current guess of the default session.
+    @property
+    def guess(self):
+        return self.session.guess
+
+
+    # *** prob_sums ***
+    # Returns: A dictionary with the summation of the probabilities in the history of each
+    #          id candidate, for the default session.
+    @property
+    def prob_sums(self):
+        return dict(zip(self.id_list,self.session.history_sums))
+
+
+    # *** probab_histories ***
+    # Returns: A dictionary with the list of encountered probabilities of each id candidate,
+    #          oldest first, for the default session.
+    @property
+    def probab_histories(self):
+        ordered = numpy.roll(self.session.history,-self.session.history_pos,axis=1)
+        return dict(zip(self.id_list,ordered.tolist()))
 
 
     # *** keypairtime_prob_density ***
@@ -110,59 +351,148 @@ class KDIdentifier:
     def keypairtime_prob_density(self,pair,time,known_id):
         success = False
         prob_dens = 0.0
-        if( pair in known_id.freq_pairs ):
+        column = self.pair_column(pair)
+        i = self.id_list.index(known_id.id_name)
+        if( column >= 0 and self.params[i,column,PRESENT] ):
             if(self.use_log_norm_pdf):
-                data = known_id.freq_pairs[pair]
-                logdata = numpy.log(data)
-                std_of_logdata = numpy.std(logdata)
-                mean_of_logdata = numpy.mean(logdata)
-                log_time = numpy.log(time)
-                prob_dens = normal_pdf(std_of_logdata,mean_of_logdata,log_time)
-                success = True
-            else:
-                std = numpy.std(known_id.freq_pairs[pair])
-                mean = numpy.mean(known_id.freq_pairs[pair])
-                prob_dens = normal_pdf(std,mean,time)
-                success = True
+                time = numpy.log(time)
+            prob_dens = normal_pdf(self.pdf_stds[i,column],self.pdf_means[i,column],time)
+            success = True
         return success,prob_dens
 
 
+    # *** pair_column ***
+    # pair: The tuple with the pair of ascii keys
+    # Returns: The column of the pair in the parameter matrices, or -1 if no id has it.
+    def pair_column(self,pair):
+        code = kd_pairs.pair_code(pair)
+        if( code < 0 ):
+            return -1
+        return self.pair_columns[code]
+
+
     # *** processKeystroke ***
     # Processes a keystroke, and computes a new "guess" for the identity.
     # ascii_code: The ascii code of the key just pressed
     # timestamp:  The timestamp of the keypress.
     def processKeystroke(self,ascii_code,timestamp):
-        self.curr_ascii = ascii_code
-        self.curr_timestamp = timestamp
-        if( self.prev_ascii >= 0 and self.prev_timestamp >= 0. ):
-            pair = (self.prev_ascii,self.curr_ascii)
-            time = self.curr_timestamp - self.prev_timestamp
+        self.step(self.session,ascii_code,timestamp)
 
-            for id in self.known_ids:
-                self.success_bool[id],self.probs[id] = self.keypairtime_prob_density(pair,time,self.known_ids[id])
 
-            # we only use it if all of the ids had this pair
-            success_all = True
-            for id in self.known_ids:
-                success_all = success_all and self.success_bool[id]
-
-            if( success_all ):
-                for id in self.known_ids:
-                    # Append the newest probability, and remove the oldest one from the history.
-                    self.probab_histories[id].remove(self.probab_histories[id][0])
-                    self.probab_histories[id].append(self.probs[id])
-
-                for id in self.known_ids:
-                    self.prob_sums[id] = numpy.sum(numpy.array(self.probab_histories[id]))
-
-                self.guess, max_prob = find_max(self.prob_sums)
+    # *** step ***
+    # Processes a keystroke of one of many typists, and computes a new "guess" for them.
+    # session: The KDSession of the typist
+    # ascii_code: The ascii code of the key just pressed
+    # timestamp:  The timestamp of the keypress.
+    # Returns: The new guess.
+    def step(self,session,ascii_code,timestamp):
+        # Stage timings and counters, when enabled (see instrumentation)
+        instruments = self.instruments
+        if( instruments is not None ):
+            start = clock()
 
-        self.prev_ascii = self.curr_ascii
-        self.prev_timestamp = self.curr_timestamp
+        if( session.prev_ascii >= 0 and session.prev_timestamp >= 0. ):
+            column = self.pair_column((session.prev_ascii,ascii_code))
+            time = timestamp - session.prev_timestamp
 
+            # we only use it if all of the ids had this pair
+            if( column >= 0 and self.present_in_all[column] ):
+                if(self.use_log_norm_pdf):
+                    time = numpy.log(time)
+                # The probability densities of all the ids at once
+                newest = normal_pdf(self.pdf_stds[:,column],self.pdf_means[:,column],time)
+                if( instruments is not None ):
+                    density_done = clock()
+                    instruments.record("density",density_done-start)
+                    instruments.count("pairs_scored")
+                    instruments.count("density_evaluations",len(self.id_list))
+
+                # Overwrite the oldest probability in the ring buffer with the newest one,
+                # and update the running sums by the difference.
+                pos = session.history_pos
+                session.history_sums += newest - session.history[:,pos]
+                session.history[:,pos] = newest
+                pos += 1
+                if( pos == self.history_length ):
+                    # Re-summing once per lap keeps rounding errors from accumulating
+                    pos = 0
+                    session.history_sums = numpy.sum(session.history,axis=1)
+                session.history_pos = pos
+                if( instruments is not None ):
+                    history_done = clock()
+                    instruments.record("history",history_done-density_done)
+
+                session.guess = self.id_list[numpy.argmax(session.history_sums)]
+                if( instruments is not None ):
+                    instruments.record("argmax",clock()-history_done)
+            elif( instruments is not None ):
+                if( column < 0 ):
+                    instruments.count("pairs_unknown")
+                else:
+                    instruments.count("pairs_missing_from_some_id")
+
+        session.prev_ascii = ascii_code
+        session.prev_timestamp = timestamp
+        if( instruments is not None ):
+            instruments.record("keystroke",clock()-start)
+            instruments.count("keystrokes")
+            instruments.tick()
+        return session.guess
+
+
+    # *** process_batch ***
+    # Replays a whole recording offline, giving the same guesses as calling processKeystroke
+    # on each keystroke of it, starting from an empty history.  The live state is not touched.
+    # asciicodes: The array of ascii codes of the keys pressed
+    # timestamps: The array of timestamps of the keypresses.
+    # Returns: guesses, an array with the guess after each keystroke, and scores, an array of
+    #          shape (keystrokes, identities) with the probability sums after each keystroke,
+    #          with the identities in the order of id_list.
+    def process_batch(self,asciicodes,timestamps):
+        timestamps = numpy.asarray(timestamps,dtype=numpy.float64)
+        num_keys = len(timestamps)
+        num_ids = len(self.id_list)
+
+        # Finding the pairs that every id has, like processKeystroke does
+        codes = kd_store.pack_pairs(asciicodes)
+        times = numpy.diff(timestamps)
+        columns = numpy.full(len(codes),-1,dtype=numpy.int64)
+        valid = (codes >= 0) & (timestamps[:-1] >= 0.)
+        columns[valid] = self.pair_columns[codes[valid]]
+        used = numpy.nonzero(columns >= 0)[0]
+        used = used[self.present_in_all[columns[used]]]
+
+        # The probability densities of all the used pairs, for all the ids at once
+        times = times[used]
+        if(self.use_log_norm_pdf):
+            times = numpy.log(times)
+        columns = columns[used]
+        dens = normal_pdf(self.pdf_stds[:,columns],self.pdf_means[:,columns],times)
+
+        # Sliding window sums over the history.  The cumulative sums restart for each block
+        # of history_length pairs, so rounding errors stay as small as in the ring buffer.
+        length = self.history_length
+        num_used = len(used)
+        num_blocks = -(-num_used // length)
+        blocks = numpy.zeros((num_ids,num_blocks*length))
+        blocks[:,:num_used] = dens
+        prefix = numpy.cumsum(blocks.reshape(num_ids,num_blocks,length),axis=2)
+        window = prefix.copy()
+        window[:,1:,:] += prefix[:,:-1,-1:] - prefix[:,:-1,:]
+        window = window.reshape(num_ids,-1)[:,:num_used]
+
+        # Spreading the sums back over the keystrokes; pair i ends at keystroke i+1
+        latest = numpy.searchsorted(used+1,numpy.arange(num_keys),side="right") - 1
+        seen = latest >= 0
+        scores = numpy.zeros((num_keys,num_ids))
+        scores[seen] = window[:,latest[seen]].T
+        guesses = numpy.full(num_keys,"<none>",dtype=object)
+        guesses[seen] = numpy.array(self.id_list,dtype=object)[numpy.argmax(scores[seen],axis=1)]
+        return guesses,scores
 
 
 if __name__ == "__main__":
+    from kd_analyze import KDAnalyzer
     id_names_files = {"steven":["data/steven_gettysburg.txt","data/steven_gettysburg2.txt"],
                       "nozomu":["data/nozomu_gettysburg.txt"],
                       "lawrence":["data/lawrence_gettysburg.txt"],
@@ -179,18 +509,16 @@ if __name__ == "__main__":
     # by reading in the file top-to-bottom as if the person was typing it.
 
     # Open the input file
-    inputdata = numpy.loadtxt(inputfiles[2])
-    asciicodes = inputdata[:,0].astype(numpy.int64)
-    timestamps = inputdata[:,1]
+    asciicodes, timestamps = kd_store.load_keystrokes(inputfiles[2])
 
     kdidentifier = KDIdentifier(id_names_files,
                                 history_length=100,
                                 use_log_norm_pdf=False)
 
-    # Now, iterate through each pair of letters, as if getting them from a live-stream
+    # Now, replay each pair of letters, as if getting them from a live-stream
+    guesses,scores = kdidentifier.process_batch(asciicodes,timestamps)
     for i in range(0,len(timestamps)):
-        kdidentifier.processKeystroke(asciicodes[i],timestamps[i])
-        print("Guess: ",kdidentifier.guess, " Probabs: ",kdidentifier.prob_sums)
+        print("Guess: ",guesses[i], " Probabs: ",dict(zip(kdidentifier.id_list,scores[i])))
 
     # Plotting one of the distributions with the data just to look at it.
     import matplotlib
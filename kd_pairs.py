@@ -0,0 +1,168 @@
+"""
+Vectorized key-pair extraction and grouping
+
+Every consecutive pair of key presses (a, b) is packed into a single integer
+code a*256+b, and the timings of all pairs are grouped into contiguous
+CSR-style arrays: sorted unique codes, offsets into a timing array, and the
+timing array itself, so the timings of codes[i] are
+timings[offsets[i]:offsets[i+1]].  Only keys in the range [0, 256) take part
+in pairs; a pair touching any other key is dropped.
+"""
+import numpy as np
+import kd_store
+from kd_store import KEY_RADIX, pack_pairs
+
+NUM_PAIR_CODES = KEY_RADIX * KEY_RADIX
+
+
+def pair_code(pair):
+    """
+     * pair is a tuple of two ascii codes
+
+    returns the packed code of pair, or -1 when either key is outside
+    [0, KEY_RADIX)
+    """
+    a, b = int(pair[0]), int(pair[1])
+    if 0 <= a < KEY_RADIX and 0 <= b < KEY_RADIX:
+        return a * KEY_RADIX + b
+    return -1
+
+
+def pair_key(code):
+    """
+     * code is a packed key-pair code
+
+    returns the tuple of two ascii codes packed in code
+    """
+    return divmod(int(code), KEY_RADIX)
+
+
+def extract_pairs(asciicodes, timestamps, time_interval_threshold=None):
+    """
+     * asciicodes is an array of key codes in the order they were pressed
+     * timestamps is an array of the matching key press times
+     * time_interval_threshold, if given, drops pairs whose absolute interval
+       is not below it; the kept timings are then absolute intervals
+
+    returns (codes, timings) of the kept key pairs, in typing order
+    """
+    return _filter_pairs(pack_pairs(asciicodes),
+                         np.diff(np.asarray(timestamps, dtype=np.float64)),
+                         time_interval_threshold)
+
+
+def _filter_pairs(codes, timings, time_interval_threshold):
+    """
+    drops invalid pairs and applies time_interval_threshold
+    """
+    keep = codes >= 0
+    if time_interval_threshold is not None:
+        timings = np.abs(timings)
+        keep &= timings < time_interval_threshold
+    if keep.all():
+        return codes, timings
+    return codes[keep], timings[keep]
+
+
+def load_pairs(filename, time_interval_threshold=None):
+    """
+    same as extract_pairs, for a text log or binary keystroke file
+    """
+    codes, timings = kd_store.load_pairs(filename)
+    return _filter_pairs(codes, timings, time_interval_threshold)
+
+
+class PairGroups:
+    """
+    Timings grouped by packed key-pair code, in CSR layout
+    """
+
+    def __init__(self, codes, offsets, timings):
+        """
+         * codes must be a sorted array of unique packed key-pair codes
+         * offsets must be an array of len(codes)+1 offsets into timings
+         * timings must be an array of timings ordered by code
+        """
+        self.codes = codes
+        self.offsets = offsets
+        self.timings = timings
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, pair):
+        return self.index(pair_code(pair)) >= 0
+
+    def counts(self):
+        """
+        returns the number of timings of each code
+        """
+        return np.diff(self.offsets)
+
+    def index(self, code):
+        """
+        returns the position of code in self.codes, or -1 when absent
+        """
+        i = int(np.searchsorted(self.codes, code))
+        if i < len(self.codes) and self.codes[i] == code:
+            return i
+        return -1
+
+    def group(self, i):
+        """
+        returns a view of the timings of self.codes[i]
+        """
+        return self.timings[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, pair, default=None):
+        """
+        returns a view of the timings of pair, or default when absent
+        """
+        i = self.index(pair_code(pair))
+        if i < 0:
+            return default
+        return self.group(i)
+
+    def items(self):
+        """
+        yields (pair, timings) for every pair, in code order
+        """
+        for i, code in enumerate(self.codes):
+            yield pair_key(code), self.group(i)
+
+    def to_dict(self):
+        """
+        returns a dictionary of keypair: timings, where timings are views
+        """
+        return dict(self.items())
+
+
+def group_pairs(codes, timings):
+    """
+     * codes is an array of packed key-pair codes
+     * timings is an array of the matching timings
+
+    returns a PairGroups; the timings of each code keep their original order
+    """
+    codes = np.asarray(codes)
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    unique, starts = np.unique(sorted_codes, return_index=True)
+    offsets = np.append(starts, len(sorted_codes)).astype(np.int64)
+    return PairGroups(unique, offsets, np.asarray(timings)[order])
+
+
+def group_files(filenames, time_interval_threshold=None):
+    """
+     * filenames is a list of text logs or binary keystroke files
+     * time_interval_threshold is as in extract_pairs
+
+    returns a PairGroups of the key pairs in all of the files; no pair spans
+    two files
+    """
+    extracted = [load_pairs(f, time_interval_threshold) for f in filenames]
+    if not extracted:
+        return group_pairs(np.empty(0, dtype=np.int32), np.empty(0))
+    codes = np.concatenate([c for c, _ in extracted])
+    timings = np.concatenate([t for _, t in extracted])
+    return group_pairs(codes, timings)
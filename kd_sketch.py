@@ -0,0 +1,197 @@
+"""
+Bounded-memory quantile sketches for key-pair timings
+
+A QuantileSketch summarizes a stream of timings in memory that does not grow
+with the stream: exact count, min, max, mean and standard deviation, plus
+approximate quantiles from a KLL-style compactor hierarchy.  Level h holds
+items standing for 2**h timings each; when the sketch is full, the lowest
+overfull level is sorted and every other item (from a random offset) is
+promoted to the level above.  With k=200 the rank error of a quantile is
+typically below 1-2%; the error shrinks roughly as 1/k.
+"""
+import math
+import numpy as np
+
+DEFAULT_K = 200
+
+# Empirical constant relating k to the normalized rank error of KLL sketches
+# (about 1.65% at k=200, with high probability)
+_ERROR_CONSTANT = 3.3
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles and exact moments of a stream of values
+    """
+
+    def __init__(self, k=DEFAULT_K, seed=None):
+        """
+         * k controls accuracy and size; the sketch holds O(k) values
+         * seed seeds the random offsets used when compacting
+        """
+        if k < 8:
+            raise ValueError("k must be at least 8")
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._rng = np.random.default_rng(seed)
+
+    @classmethod
+    def for_error(cls, rank_error, seed=None):
+        """
+        returns an empty sketch sized for the given normalized rank error,
+        e.g. 0.01 for quantiles within about 1% of rank
+        """
+        return cls(max(8, int(math.ceil(_ERROR_CONSTANT / rank_error))), seed)
+
+    def __len__(self):
+        return self.count
+
+    def rank_error(self):
+        """
+        returns the approximate normalized rank error of quantile
+        """
+        return _ERROR_CONSTANT / self.k
+
+    def _capacity(self, level):
+        """
+        returns the number of items level may hold before compacting
+        """
+        depth = len(self.levels) - 1 - level
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        """
+        compacts overfull levels until the sketch fits its capacity
+        """
+        while sum(len(lv) for lv in self.levels) > \
+                sum(self._capacity(h) for h in range(len(self.levels))):
+            for h, items in enumerate(self.levels):
+                if len(items) >= self._capacity(h):
+                    break
+            items = np.sort(items)
+            kept = np.empty(0)
+            if len(items) % 2:
+                # an odd item out stays at this level
+                kept, items = items[:1], items[1:]
+            promoted = items[self._rng.integers(2)::2]
+            self.levels[h] = kept
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+
+    def _add_moments(self, count, mean, m2):
+        """
+        folds the moments of another sample into these ones
+        """
+        total = self.count + count
+        delta = mean - self._mean
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self._mean += delta * count / total
+        self.count = total
+
+    def extend(self, values):
+        """
+        adds an array of values to the sketch
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        mean = float(values.mean())
+        self._add_moments(len(values), mean,
+                          float(((values - mean) ** 2).sum()))
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+
+    def merge(self, other):
+        """
+        adds the values summarized by other to this sketch
+
+        returns self
+        """
+        if other.count == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._add_moments(other.count, other._mean, other._m2)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], items))
+        self._compress()
+        return self
+
+    def mean(self):
+        """
+        returns the exact mean of the values
+        """
+        return self._mean if self.count else math.nan
+
+    def std(self):
+        """
+        returns the exact (population) standard deviation of the values
+        """
+        return math.sqrt(self._m2 / self.count) if self.count else math.nan
+
+    def quantiles(self, qs):
+        """
+        returns the approximate values at the fractions qs (0 to 1) of the
+        ranked values
+        """
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.count == 0:
+            return np.full(qs.shape, math.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(lv), 2.0 ** h)
+                                  for h, lv in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+        ranks = qs * cumulative[-1]
+        result = items[np.minimum(np.searchsorted(cumulative, ranks),
+                                  len(items) - 1)]
+        # the extremes are known exactly
+        result = np.where(qs <= 0.0, self.min, result)
+        return np.where(qs >= 1.0, self.max, result)
+
+    def quantile(self, q):
+        """
+        returns the approximate value at fraction q (0 to 1) of the ranked
+        values
+        """
+        return float(self.quantiles([q])[0])
+
+    def boxplot_stats(self, label=None, whis=1.5):
+        """
+        returns a dictionary for matplotlib's Axes.bxp; whiskers reach the
+        furthest values within whis inter-quartile ranges, and outliers are
+        not kept
+        """
+        q1, med, q3 = self.quantiles([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        return {"label": label,
+                "med": med, "q1": q1, "q3": q3,
+                "whislo": max(self.min, q1 - whis * iqr),
+                "whishi": min(self.max, q3 + whis * iqr),
+                "mean": self.mean(),
+                "fliers": []}
+
+
+def summarize(values):
+    """
+     * values is either a QuantileSketch or a sequence of raw values
+
+    returns (count, mean, min, max, standard deviation)
+    """
+    if isinstance(values, QuantileSketch):
+        return values.count, values.mean(), values.min, values.max, \
+            values.std()
+    values = np.asarray(values)
+    return len(values), values.sum() / len(values), np.min(values), \
+        np.max(values), np.std(values)
@@ -0,0 +1,170 @@
+"""
+Mergeable per-key-pair timing statistics
+
+A PairStats holds, for every packed key-pair code, the count, mean and sum of
+squared deviations of the timings and of their logarithms.  Statistics of
+separate recordings (or of shards computed on different machines) combine
+exactly with merge, using the pairwise update of Chan et al., so enrolling a
+new recording costs time proportional to that recording only.
+"""
+import numpy as np
+import kd_pairs
+import kd_store
+
+# the arrays of statistics, each indexed by packed key-pair code
+FIELDS = ("count", "mean", "m2", "log_mean", "log_m2")
+
+
+def _batch_moments(codes, values, counts):
+    """
+    returns per-code (mean, m2) of values, for codes with the given counts
+    """
+    size = len(counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(codes, weights=values, minlength=size) / counts
+        deviations = values - mean[codes]
+        m2 = np.bincount(codes, weights=deviations * deviations,
+                         minlength=size)
+    mean[counts == 0] = 0.0
+    return mean, m2
+
+
+class PairStats:
+    """
+    Count, mean and spread of the timings of every key pair
+    """
+
+    def __init__(self, time_interval_threshold=1.2):
+        """
+         * time_interval_threshold is the maximum time between keystrokes for
+           a pair to be counted, as in KDAnalyzer
+        """
+        self.time_interval_threshold = time_interval_threshold
+        self.count = np.zeros(kd_pairs.NUM_PAIR_CODES, dtype=np.int64)
+        self.mean = np.zeros(kd_pairs.NUM_PAIR_CODES)
+        self.m2 = np.zeros(kd_pairs.NUM_PAIR_CODES)
+        self.log_mean = np.zeros(kd_pairs.NUM_PAIR_CODES)
+        self.log_m2 = np.zeros(kd_pairs.NUM_PAIR_CODES)
+
+    @classmethod
+    def from_files(cls, filenames, time_interval_threshold=1.2):
+        """
+        returns the PairStats of the text logs or binary keystroke files
+        """
+        stats = cls(time_interval_threshold)
+        for filename in filenames:
+            stats.add_file(filename)
+        return stats
+
+    def _combine(self, count, mean, m2, log_mean, log_m2):
+        """
+        folds the statistics of another sample into these ones
+        """
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, count / total, 0.0)
+            cross = self.count * weight
+            delta = mean - self.mean
+            self.m2 += m2 + delta * delta * cross
+            self.mean += delta * weight
+            delta = log_mean - self.log_mean
+            self.log_m2 += log_m2 + delta * delta * cross
+            self.log_mean += delta * weight
+        self.count = total
+
+    def add(self, codes, timings):
+        """
+         * codes is an array of packed key-pair codes
+         * timings is an array of the matching timings, already filtered by
+           time_interval_threshold
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        timings = np.asarray(timings, dtype=np.float64)
+        count = np.bincount(codes, minlength=kd_pairs.NUM_PAIR_CODES)
+        mean, m2 = _batch_moments(codes, timings, count)
+        with np.errstate(divide="ignore"):
+            log_mean, log_m2 = _batch_moments(codes, np.log(timings), count)
+        self._combine(count, mean, m2, log_mean, log_m2)
+
+    def add_keystrokes(self, asciicodes, timestamps):
+        """
+         * asciicodes is an array of key codes in the order they were pressed
+         * timestamps is an array of the matching key press times
+        """
+        self.add(*kd_pairs.extract_pairs(asciicodes, timestamps,
+                                         self.time_interval_threshold))
+
+    def add_file(self, filename):
+        """
+         * filename is the name of a text log or binary keystroke file
+        """
+        self.add(*kd_pairs.load_pairs(filename, self.time_interval_threshold))
+
+    def merge(self, other):
+        """
+        adds the statistics of other, a PairStats with the same
+        time_interval_threshold, to these ones
+
+        returns self
+        """
+        if other.time_interval_threshold != self.time_interval_threshold:
+            raise ValueError("cannot merge statistics with different time "
+                             "interval thresholds (%r and %r)" %
+                             (self.time_interval_threshold,
+                              other.time_interval_threshold))
+        self._combine(other.count, other.mean, other.m2,
+                      other.log_mean, other.log_m2)
+        return self
+
+    def copy(self):
+        """
+        returns an independent copy of these statistics
+        """
+        result = PairStats(self.time_interval_threshold)
+        for field in FIELDS:
+            setattr(result, field, getattr(self, field).copy())
+        return result
+
+    def std(self):
+        """
+        returns the (population) standard deviation of the timings of each
+        code; 0 where there are none
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0,
+                            np.sqrt(self.m2 / self.count), 0.0)
+
+    def log_std(self):
+        """
+        returns the (population) standard deviation of the log-timings of each
+        code; 0 where there are none
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0,
+                            np.sqrt(self.log_m2 / self.count), 0.0)
+
+    def save(self, path):
+        """
+        writes the statistics of the codes that occur to path
+        """
+        codes = np.nonzero(self.count)[0]
+        columns = {"codes": codes}
+        for field in FIELDS:
+            columns[field] = getattr(self, field)[codes]
+        kd_store.write_columns(path, columns, {
+            "kind": "pair_stats",
+            "time_interval_threshold": self.time_interval_threshold})
+
+    @classmethod
+    def load(cls, path):
+        """
+        returns the PairStats saved to path
+        """
+        meta, columns = kd_store.read_columns(path)
+        if meta.get("kind") != "pair_stats":
+            raise ValueError("%s does not hold pair statistics" % path)
+        stats = cls(meta["time_interval_threshold"])
+        codes = columns["codes"]
+        for field in FIELDS:
+            getattr(stats, field)[codes] = columns[field]
+        return stats
@@ -0,0 +1,300 @@
+"""
+Binary columnar storage for keystroke logs
+
+Parsing the "<ascii> <timestamp>" text logs with numpy.loadtxt is the slowest
+part of loading a large corpus.  This module converts each text log once into
+a flat binary file (a small JSON header followed by aligned raw columns) which
+is cached on disk under the SHA-1 of the source file, and opened afterwards
+with numpy.memmap so that loading copies nothing.
+
+Columns of a keystroke file:
+ * asciicodes: int16, one per keystroke
+ * timestamps: float64, one per keystroke
+ * pair_codes: int32, one per consecutive key pair, packed as a*256+b, or
+   -1 where a key is outside [0, 256) (optional)
+ * pair_times: float64, the time between the two key presses of each pair
+   (optional)
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import numpy as np
+
+MAGIC = b"KDSTORE1"
+ALIGNMENT = 64
+KEY_DTYPE = np.int16
+KEY_RADIX = 256
+CACHE_DIR = os.environ.get("KD_CACHE_DIR", ".kdcache")
+EXTENSION = ".kds"
+
+_HEADER_LEN = struct.Struct("<Q")
+
+
+def _aligned(offset):
+    """
+    returns offset rounded up to the next multiple of ALIGNMENT
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_columns(path, columns, meta=None):
+    """
+    writes arrays to a flat binary file that read_columns can memory-map
+     * path is the name of the file to write; it is written to a temporary
+       file first and renamed, so readers never see a partial file
+     * columns is a dictionary of name: numpy array
+     * meta is a JSON-serializable dictionary stored in the header
+    """
+    columns = {name: np.ascontiguousarray(arr) for name, arr in columns.items()}
+    layout = {}
+    # the offsets depend on the header length, which depends on the offsets;
+    # settle it by iterating until the header stops growing
+    header_size = 0
+    while True:
+        offset = _aligned(len(MAGIC) + _HEADER_LEN.size + header_size)
+        for name, arr in columns.items():
+            layout[name] = {"dtype": arr.dtype.str,
+                            "shape": list(arr.shape),
+                            "offset": offset}
+            offset = _aligned(offset + arr.nbytes)
+        header = json.dumps({"meta": meta or {}, "columns": layout},
+                            sort_keys=True).encode("utf-8")
+        if len(header) <= header_size:
+            break
+        header_size = len(header)
+    header = header.ljust(header_size)
+
+    tmppath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmppath, "wb") as ofh:
+        ofh.write(MAGIC)
+        ofh.write(_HEADER_LEN.pack(header_size))
+        ofh.write(header)
+        for name, arr in columns.items():
+            ofh.seek(layout[name]["offset"])
+            ofh.write(arr.tobytes())
+        ofh.truncate(offset)
+    os.replace(tmppath, path)
+
+
+def read_header(path):
+    """
+    returns the header dictionary of a file written by write_columns
+    """
+    with open(path, "rb") as ifh:
+        if ifh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a %s file" % (path, MAGIC.decode()))
+        header_size, = _HEADER_LEN.unpack(ifh.read(_HEADER_LEN.size))
+        return json.loads(ifh.read(header_size).decode("utf-8"))
+
+
+def read_columns(path):
+    """
+     * path is the name of a file written by write_columns
+
+    returns (meta, columns) where columns is a dictionary of name: read-only
+    numpy.memmap
+    """
+    header = read_header(path)
+    columns = {}
+    for name, spec in header["columns"].items():
+        shape = tuple(spec["shape"])
+        if 0 in shape:
+            # mmap cannot map an empty region
+            columns[name] = np.empty(shape, dtype=spec["dtype"])
+        else:
+            columns[name] = np.memmap(path, dtype=spec["dtype"], mode="r",
+                                      offset=spec["offset"], shape=shape)
+    return header["meta"], columns
+
+
+def file_hash(filename):
+    """
+    returns the hex SHA-1 of the contents of filename
+    """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as ifh:
+        for block in iter(lambda: ifh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(filename, cache_dir=None):
+    """
+    returns the name of the cached binary file for the text log filename
+    """
+    return os.path.join(cache_dir or CACHE_DIR, file_hash(filename) + EXTENSION)
+
+
+def parse_text(filename):
+    """
+     * filename is the name of a file from which to load data; each line should
+       contain <integer><whitespace><float>, where the integer is an ascii key
+       code and the float is the timestamp when the key was pressed
+
+    returns (asciicodes, timestamps) as numpy arrays
+    """
+    rawdata = np.loadtxt(filename, ndmin=2)
+    if rawdata.size == 0:
+        return np.empty(0, dtype=KEY_DTYPE), np.empty(0)
+    codes = rawdata[:, 0]
+    info = np.iinfo(KEY_DTYPE)
+    if codes.min() < info.min or codes.max() > info.max:
+        raise ValueError("%s has key codes outside the %s range" %
+                         (filename, np.dtype(KEY_DTYPE).name))
+    return codes.astype(KEY_DTYPE), rawdata[:, 1].astype(np.float64)
+
+
+def pack_pairs(asciicodes):
+    """
+     * asciicodes is an array of key codes in the order they were pressed
+
+    returns an int32 array with the packed code a*KEY_RADIX+b of each
+    consecutive pair, or -1 where either key is outside [0, KEY_RADIX)
+    """
+    codes = np.asarray(asciicodes).astype(np.int32)
+    valid = (codes >= 0) & (codes < KEY_RADIX)
+    packed = codes[:-1] * KEY_RADIX + codes[1:]
+    packed[~(valid[:-1] & valid[1:])] = -1
+    return packed
+
+
+def _pair_columns(asciicodes, timestamps):
+    """
+    returns (pair_codes, pair_times) for consecutive key presses
+    """
+    return pack_pairs(asciicodes), np.diff(timestamps)
+
+
+def convert(filename, out=None, pairs=True, cache_dir=None):
+    """
+    converts a text log into the binary format
+     * filename is the name of a text log
+     * out is the name of the file to write; by default it is the cache path
+       of filename
+     * pairs is whether to also store the precomputed key-pair columns
+
+    returns the name of the written file
+    """
+    if out is None:
+        out = cache_path(filename, cache_dir)
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    asciicodes, timestamps = parse_text(filename)
+    columns = {"asciicodes": asciicodes, "timestamps": timestamps}
+    if pairs:
+        columns["pair_codes"], columns["pair_times"] = \
+            _pair_columns(asciicodes, timestamps)
+    write_columns(out, columns, {"kind": "keystrokes",
+                                 "source": os.path.basename(filename),
+                                 "length": len(asciicodes)})
+    return out
+
+
+def is_store_file(filename):
+    """
+    returns whether filename was written by write_columns, as opposed to
+    being a text log (or a pickle)
+    """
+    with open(filename, "rb") as ifh:
+        return ifh.read(len(MAGIC)) == MAGIC
+
+
+def open_store(filename, cache_dir=None):
+    """
+    returns the memory-mapped columns for filename, which may be a text log
+    or a binary file; text logs are converted on first use and cached
+    """
+    if is_store_file(filename):
+        path = filename
+    else:
+        path = cache_path(filename, cache_dir)
+        if not os.path.exists(path):
+            convert(filename, out=None, cache_dir=cache_dir)
+    _, columns = read_columns(path)
+    return columns
+
+
+def load_keystrokes(filename, cache_dir=None):
+    """
+     * filename is the name of a text log or binary keystroke file
+
+    returns (asciicodes, timestamps) as read-only memory-mapped arrays
+    """
+    columns = open_store(filename, cache_dir)
+    return columns["asciicodes"], columns["timestamps"]
+
+
+def load_pairs(filename, cache_dir=None):
+    """
+     * filename is the name of a text log or binary keystroke file
+
+    returns (pair_codes, pair_times); these are memory-mapped when the file
+    holds the precomputed key-pair columns and computed otherwise
+    """
+    columns = open_store(filename, cache_dir)
+    if "pair_codes" in columns:
+        return columns["pair_codes"], columns["pair_times"]
+    return _pair_columns(columns["asciicodes"], columns["timestamps"])
+
+
+def _convert_files(args):
+    """
+    runs conversion task
+    """
+    for filename in args.files:
+        out = None
+        if args.outdir is not None:
+            os.makedirs(args.outdir, exist_ok=True)
+            out = os.path.join(args.outdir, os.path.splitext(
+                os.path.basename(filename))[0] + EXTENSION)
+        print(filename, "->", convert(filename, out, pairs=not args.no_pairs))
+
+
+def _show_info(args):
+    """
+    runs info task
+    """
+    for filename in args.files:
+        header = read_header(filename)
+        print(filename, json.dumps(header["meta"], sort_keys=True))
+        for name, spec in sorted(header["columns"].items()):
+            print("  %-12s %-6s %s" % (name, spec["dtype"], spec["shape"]))
+
+
+def _run():
+    """
+    parses arguments and runs appropriate task
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert keystroke logs to the binary columnar format.")
+    subparsers = parser.add_subparsers()
+
+    convertparser = subparsers.add_parser(
+        "convert", help="convert text logs")
+    convertparser.add_argument(
+        "files", nargs="+",
+        help="text logs where each line contains <integer><whitespace><float>")
+    convertparser.add_argument(
+        "--outdir", "-o",
+        help="directory to write converted files to; by default they are "
+        "written to the cache directory (%s)" % CACHE_DIR)
+    convertparser.add_argument(
+        "--no-pairs", action="store_true",
+        help="do not store the precomputed key-pair columns")
+    convertparser.set_defaults(func=_convert_files)
+
+    infoparser = subparsers.add_parser("info", help="describe binary files")
+    infoparser.add_argument(
+        "files", nargs="+", help="binary keystroke or model files")
+    infoparser.set_defaults(func=_show_info)
+
+    args = parser.parse_args()
+    if "func" not in args:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+if __name__ == "__main__":
+    _run()
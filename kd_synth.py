@@ -0,0 +1,296 @@
+"""
+Synthetic keystroke corpora for scaling tests
+
+A TypistProfile is a log-normal distribution of the time between the two key
+presses of every key pair, fitted from a typist's recordings through
+kd_stats.PairStats; pairs the typist typed too rarely fall back to the
+pooled profile of every typist, and pairs nobody typed to the typist's
+overall timing.  Pauses longer than the time interval threshold, which
+PairStats leaves out, are drawn separately at the rate they occurred.
+
+generate_corpus derives any number of synthetic typists from the real ones,
+by shifting each one's overall speed and every pair's timing by random
+amounts, and writes sessions of them typing given texts in the same
+"<ascii> <timestamp>" format as the recordings.  Everything is drawn from a
+seeded numpy Generator, and typist i and session j of typist i are drawn from
+streams of their own, so the same seed always yields the same files and
+asking for more typists or sessions leaves the earlier ones unchanged.
+"""
+import argparse
+import os
+import numpy as np
+import kd_pairs
+import kd_store
+from kd_stats import PairStats
+
+DEFAULT_MIN_COUNT = 5
+# start of the first session of every typist, in seconds since the epoch
+DEFAULT_START_TIME = 1.5e9
+
+
+class TypistProfile:
+    """
+    Log-normal timing of every key pair of one typist
+    """
+
+    def __init__(self, log_mean, log_std, pause_rate=0.0, pause_log_mean=0.0,
+                 pause_log_std=0.0):
+        """
+         * log_mean and log_std are arrays indexed by packed key-pair code of
+           the mean and standard deviation of the log-timings
+         * pause_rate is the fraction of key pairs followed by a pause instead
+         * pause_log_mean and pause_log_std describe the log-lengths of pauses
+        """
+        self.log_mean = log_mean
+        self.log_std = log_std
+        self.pause_rate = pause_rate
+        self.pause_log_mean = pause_log_mean
+        self.pause_log_std = pause_log_std
+
+    @classmethod
+    def from_stats(cls, stats, population=None, min_count=DEFAULT_MIN_COUNT,
+                   pauses=None):
+        """
+         * stats is the PairStats of the typist
+         * population, if given, is the PairStats of every typist, used for
+           the pairs this one typed fewer than min_count times
+         * pauses, if given, is an array of the pause lengths of the typist
+           and the number of key pairs they came from, as from pause_lengths
+
+        returns a TypistProfile
+        """
+        overall_mean, overall_std = _overall(stats)
+        log_mean = np.full(kd_pairs.NUM_PAIR_CODES, overall_mean)
+        log_std = np.full(kd_pairs.NUM_PAIR_CODES, overall_std)
+        for source in ([population] if population is not None else []) + [stats]:
+            known = source.count >= min_count
+            log_mean[known] = source.log_mean[known]
+            log_std[known] = source.log_std()[known]
+        profile = cls(log_mean, log_std)
+        if pauses is not None:
+            lengths, num_pairs = pauses
+            if len(lengths) and num_pairs:
+                logs = np.log(lengths)
+                profile.pause_rate = len(lengths) / num_pairs
+                profile.pause_log_mean = float(logs.mean())
+                profile.pause_log_std = float(logs.std())
+        return profile
+
+    @classmethod
+    def from_files(cls, filenames, population=None,
+                   min_count=DEFAULT_MIN_COUNT, time_interval_threshold=1.2):
+        """
+        returns the TypistProfile fitted from the text logs or binary
+        keystroke files of one typist; see from_stats
+        """
+        stats = PairStats.from_files(filenames, time_interval_threshold)
+        return cls.from_stats(stats, population, min_count,
+                              pause_lengths(filenames, time_interval_threshold))
+
+    def perturbed(self, rng, speed_sigma=0.15, pair_sigma=0.1,
+                  spread_sigma=0.1):
+        """
+        returns a new TypistProfile resembling this one
+         * rng is a numpy Generator
+         * speed_sigma is the standard deviation of the shift of every
+           log-timing, making the new typist faster or slower overall
+         * pair_sigma is the standard deviation of the further shift of each
+           key pair's log-timing
+         * spread_sigma is the standard deviation of the log-factor scaling
+           the spread of the log-timings
+        """
+        shift = rng.normal(0.0, speed_sigma) + \
+            rng.normal(0.0, pair_sigma, kd_pairs.NUM_PAIR_CODES)
+        spread = np.exp(rng.normal(0.0, spread_sigma))
+        return TypistProfile(self.log_mean + shift, self.log_std * spread,
+                             self.pause_rate, self.pause_log_mean,
+                             self.pause_log_std)
+
+    def sample_session(self, text, rng, num_keystrokes=None,
+                       start_time=DEFAULT_START_TIME):
+        """
+         * text is the string typed; it is repeated as needed
+         * rng is a numpy Generator
+         * num_keystrokes is the number of keystrokes; by default, the length
+           of text
+
+        returns (asciicodes, timestamps) as numpy arrays
+        """
+        codes = np.frombuffer(text.encode("latin-1", "replace"), dtype=np.uint8)
+        if num_keystrokes is None:
+            num_keystrokes = len(codes)
+        asciicodes = np.resize(codes, num_keystrokes).astype(np.int64)
+        pairs = asciicodes[:-1] * kd_pairs.KEY_RADIX + asciicodes[1:]
+        timings = np.exp(self.log_mean[pairs] + self.log_std[pairs] *
+                         rng.standard_normal(len(pairs)))
+        paused = rng.random(len(pairs)) < self.pause_rate
+        timings[paused] = np.exp(self.pause_log_mean + self.pause_log_std *
+                                 rng.standard_normal(int(paused.sum())))
+        timestamps = start_time + np.concatenate(([0.0], np.cumsum(timings)))
+        return asciicodes, timestamps
+
+
+def _overall(stats):
+    """
+    returns the mean and standard deviation of all the log-timings of stats
+    """
+    total = stats.count.sum()
+    if total == 0:
+        return 0.0, 0.0
+    mean = (stats.count * stats.log_mean).sum() / total
+    m2 = stats.log_m2.sum() + (stats.count * (stats.log_mean - mean) ** 2).sum()
+    return float(mean), float(np.sqrt(m2 / total))
+
+
+def pause_lengths(filenames, time_interval_threshold=1.2):
+    """
+    returns (lengths, num_pairs): an array of the times between key presses
+    of at least time_interval_threshold in the files, and the number of key
+    pairs in them
+    """
+    lengths = []
+    num_pairs = 0
+    for filename in filenames:
+        _, timings = kd_store.load_pairs(filename)
+        timings = np.abs(np.asarray(timings))
+        lengths.append(timings[timings >= time_interval_threshold])
+        num_pairs += len(timings)
+    return np.concatenate(lengths) if lengths else np.empty(0), num_pairs
+
+
+def fit_profiles(typist_files, min_count=DEFAULT_MIN_COUNT,
+                 time_interval_threshold=1.2):
+    """
+     * typist_files is a dictionary of typist: [files]
+
+    returns a dictionary of typist: TypistProfile, with rarely typed pairs
+    falling back to the pooled statistics of every typist
+    """
+    stats = {typist: PairStats.from_files(files, time_interval_threshold)
+             for typist, files in typist_files.items()}
+    population = PairStats(time_interval_threshold)
+    for typist_stats in stats.values():
+        population.merge(typist_stats)
+    return {typist: TypistProfile.from_stats(
+        stats[typist], population, min_count,
+        pause_lengths(files, time_interval_threshold))
+        for typist, files in typist_files.items()}
+
+
+def write_session(filename, asciicodes, timestamps):
+    """
+    writes keystrokes to filename as "<ascii> <timestamp>" lines
+    """
+    with open(filename, "w") as ofh:
+        for ascii_code, timestamp in zip(asciicodes.tolist(),
+                                         timestamps.tolist()):
+            ofh.write("%d %f\n" % (ascii_code, timestamp))
+
+
+def generate_corpus(profiles, texts, out_dir, num_typists, num_sessions=1,
+                    num_keystrokes=None, seed=0, layout="flat", **perturbation):
+    """
+     * profiles is a dictionary of typist: TypistProfile of real typists
+     * texts is a dictionary of name: text; every session types each text
+     * out_dir is the directory to write to
+     * num_typists is the number of synthetic typists; typist i derives from
+       the (i mod len(profiles))-th real typist, in sorted order
+     * num_sessions is the number of sessions of each text per typist
+     * num_keystrokes, if given, is the length of every session
+     * seed seeds everything drawn
+     * layout is "flat" to write files named <typist>_<text><session>.txt
+       into out_dir, as in data/, or "dirs" to write them into a directory
+       per typist, as the train commands take them
+     * perturbation holds keyword arguments for TypistProfile.perturbed
+
+    returns a dictionary of typist: [files written]
+    """
+    bases = sorted(profiles)
+    typist_seeds = np.random.SeedSequence(seed).spawn(num_typists)
+    written = {}
+    for i, typist_seed in enumerate(typist_seeds):
+        typist = "synth%05d" % i
+        typist_rng, *session_seeds = [np.random.default_rng(s) for s in
+                                      typist_seed.spawn(1 + num_sessions)]
+        profile = profiles[bases[i % len(bases)]].perturbed(
+            typist_rng, **perturbation)
+        directory = out_dir if layout == "flat" else os.path.join(out_dir,
+                                                                  typist)
+        os.makedirs(directory, exist_ok=True)
+        written[typist] = []
+        start_time = DEFAULT_START_TIME
+        for session, rng in enumerate(session_seeds):
+            for name in sorted(texts):
+                asciicodes, timestamps = profile.sample_session(
+                    texts[name], rng, num_keystrokes, start_time)
+                # the real recordings are numbered "", "2", "3", ...
+                filename = os.path.join(directory, "%s_%s%s.txt" % (
+                    typist, name, str(session + 1) if session else ""))
+                write_session(filename, asciicodes, timestamps)
+                written[typist].append(filename)
+                start_time = timestamps[-1] + 60.0
+    return written
+
+
+def files_by_typist(filenames):
+    """
+    returns a dictionary of typist: [files] for files named <typist>_<...>
+    """
+    typist_files = {}
+    for filename in filenames:
+        typist, sep, _ = os.path.basename(filename).partition("_")
+        if sep:
+            typist_files.setdefault(typist, []).append(filename)
+    return typist_files
+
+
+def _run():
+    """
+    parses arguments and generates a corpus
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic keystroke logs from real ones.")
+    parser.add_argument(
+        "out_dir", help="directory to write the synthetic logs to")
+    parser.add_argument(
+        "--typists", "-n", type=int, default=100,
+        help="number of synthetic typists (default: 100)")
+    parser.add_argument(
+        "--sessions", type=int, default=3,
+        help="number of sessions of each text per typist (default: 3)")
+    parser.add_argument(
+        "--keystrokes", type=int,
+        help="length of every session (default: the length of the text)")
+    parser.add_argument(
+        "--texts", nargs="+", default=["docs/gettysburg.txt"],
+        help="texts to type (default: docs/gettysburg.txt)")
+    parser.add_argument(
+        "--real", nargs="+",
+        help="recordings named <typist>_<...> to fit the profiles to "
+        "(default: data/*.txt)")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument(
+        "--layout", choices=["flat", "dirs"], default="flat",
+        help="one directory of <typist>_<text><session>.txt files, as in "
+        "data/, or a directory per typist, as the train commands take")
+    args = parser.parse_args()
+
+    real = args.real
+    if real is None:
+        real = [os.path.join("data", f) for f in sorted(os.listdir("data"))
+                if f.endswith(".txt") and f != "metadata.txt"]
+    texts = {}
+    for filename in args.texts:
+        with open(filename) as ifh:
+            texts[os.path.splitext(os.path.basename(filename))[0]] = ifh.read()
+    profiles = fit_profiles(files_by_typist(real))
+    written = generate_corpus(profiles, texts, args.out_dir, args.typists,
+                              args.sessions, args.keystrokes, args.seed,
+                              args.layout)
+    print("wrote %d files for %d typists to %s" % (
+        sum(len(files) for files in written.values()), len(written),
+        args.out_dir))
+
+if __name__ == "__main__":
+    _run()
@@ -17,13 +17,21 @@ Remember that this program is a keylogger.  Don't type anything you will regret
 typing while this program is logging keys.
 '''
 import argparse
+import os
+import queue
 import sys
+import threading
 import tkinter as tk
 import time
 import pickle
+import kd_store
+import instrumentation
 from kd_identify import KDIdentifier
-from typeroracle import TyperOracle
-from hmm_oracle import HmmOracle
+
+# how often --stats are written
+STATS_INTERVAL_MS = 10000
+# how often the GUI checks for a new guess
+GUESS_POLL_MS = 50
 
 def set_textarea(textarea, showntext):
     ''' Sets text in text area '''
@@ -31,30 +39,118 @@ def set_textarea(textarea, showntext):
     textarea.insert('1.0', showntext)
     textarea.config(state=tk.DISABLED)
 
-def highlight_text(textarea, standardtext, typedsofar):
-    ''' Highlights portions of text according to what has been typed by the user
+def _char_index(position):
+    ''' Returns the Tk text index of the character at position '''
+    return '1.0+%dc' % position
+
+class Highlighter:
+    ''' Highlights text incrementally as the user types.
+    It remembers the tag of every typed character and only re-tags the
+    characters typed or erased since its last update, so a keystroke costs the
+    same number of tag operations however long the text is.
+    '''
+    def __init__(self, textarea, standardtext):
+        self.textarea = textarea
+        self.standardtext = standardtext
+        self.tags = []
+
+    def update(self, typedsofar):
+        ''' Brings the highlighting in line with typedsofar, which must extend
+        or shorten what was typed at the last update '''
+        while len(self.tags) > len(typedsofar):
+            position = len(self.tags) - 1
+            self.textarea.tag_remove(self.tags.pop(), _char_index(position),
+                                     _char_index(position + 1))
+        for position in range(len(self.tags), len(typedsofar)):
+            if position < len(self.standardtext) and \
+                    typedsofar[position] == self.standardtext[position]:
+                tag = 'correct'
+            else:
+                tag = 'incorrect'
+            self.textarea.tag_add(tag, _char_index(position),
+                                  _char_index(position + 1))
+            self.tags.append(tag)
+
+class OracleWorker(threading.Thread):
+    ''' Runs the identifiers on keystrokes off the Tk event thread.
+    The Tk callback only timestamps each keystroke and submits it.  The worker
+    feeds every keystroke to every identifier, in order, and publishes the
+    guesses after the last one.  When it falls behind, it takes all the
+    keystrokes waiting at once and publishes only the guesses after the last
+    of them.  The identifiers' instruments are only touched by this thread,
+    so stats are written from it too, between batches, when requested.
     '''
-    position = 0
-    tag = 'correct'
-    textarea.tag_remove('correct', '1.0', 'end')
-    textarea.tag_remove('incorrect', '1.0', 'end')
-    while position < len(typedsofar):
-        start = position
-        if typedsofar[position] == standardtext[position]:
-            tag = 'correct'
-            position += 1
-            while (position < len(typedsofar)) and \
-                    (typedsofar[position] == standardtext[position]):
-                position += 1
-        else:
-            tag = 'incorrect'
-            position += 1
-            while (position < len(typedsofar)) and \
-                    (typedsofar[position] != standardtext[position]):
-                position += 1
-        textarea.tag_add(tag, '1.0+%dc' % start, '1.0+%dc' % position)
-
-def onkeypress(ofh, textarea, standardtext, typedsofar, kdidentifier, oracles):
+    # queued by request_stats, in between keystrokes
+    STATS_REQUEST = 'stats'
+
+    def __init__(self, kdidentifier, oracles, stats_path=None):
+        super().__init__(name='oracles', daemon=True)
+        self.kdidentifier = kdidentifier
+        self.oracles = oracles
+        self.stats_path = stats_path
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.latest = None
+        # keystrokes processed, and those whose guesses were never published
+        self.processed = 0
+        self.coalesced = 0
+
+    def submit(self, ascii_code, timestamp):
+        ''' Queues a keystroke for the identifiers '''
+        self.events.put((ascii_code, timestamp))
+
+    def request_stats(self):
+        ''' Asks the worker to write the stats of every identifier to
+        stats_path once it has processed the keystrokes queued so far '''
+        self.events.put(self.STATS_REQUEST)
+
+    def stop(self):
+        ''' Asks the worker to finish the keystrokes queued so far and stop '''
+        self.events.put(None)
+
+    def take_guess(self):
+        ''' Returns the guesses published since the last call, or None '''
+        with self.lock:
+            guess_str, self.latest = self.latest, None
+        return guess_str
+
+    def run(self):
+        while True:
+            batch = [self.events.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            dumping = self.STATS_REQUEST in batch
+            batch = [event for event in batch
+                     if event != self.STATS_REQUEST]
+            if batch:
+                guess_str = self.process(batch)
+                with self.lock:
+                    self.latest = guess_str
+                    self.processed += len(batch)
+                    self.coalesced += len(batch) - 1
+            if dumping:
+                dump_stats(self.stats_path,
+                           [self.kdidentifier] + self.oracles)
+            if stopping:
+                return
+
+    def process(self, batch):
+        ''' Feeds a list of (ascii code, timestamp) to every identifier and
+        returns their guesses after the last one '''
+        for ascii_code, t in batch:
+            self.kdidentifier.processKeystroke(ascii_code, t)
+            guesses = [oracle.process_keystroke(ascii_code, t)
+                       for oracle in self.oracles]
+        return ' '.join(['Guess: ' + str(self.kdidentifier.guess)] +
+                        [str(guess_o) for guess_o in guesses])
+
+def onkeypress(ofh, textarea, standardtext, typedsofar, worker):
     ''' Closure to handle modifying record of what user has typed '''
     def inner_onkeypress(event):
         ''' Callback function for when a character is typed '''
@@ -66,24 +162,29 @@ def onkeypress(ofh, textarea, standardtext, typedsofar, kdidentifier, oracles):
             eventchar = '\n'
         if len(eventchar) > 0:
             t = time.time()
+            # the identifiers run on the worker, so typing feedback never
+            # waits for them
+            worker.submit(ord(eventchar), t)
             ofh.write('%d %f\n' % (ord(eventchar), t))
             if ord(eventchar) == 8:  # if is a backspace
-                typedsofar.pop()
+                if typedsofar:
+                    typedsofar.pop()
             else:
                 typedsofar += eventchar
-            kdidentifier.processKeystroke(ord(eventchar), t)
-            guess_i = kdidentifier.guess
-
-            guess_str = "Guess: " + str(guess_i)
-            for oracle in oracles:
-                guess_o = oracle.process_keystroke(ord(eventchar), t)
-                guess_str += " " + str(guess_o)
-            print(guess_str)
 
         # sys.stdout.write(''.join(typedsofar)+'\n')
-        highlight_text(textarea, standardtext, typedsofar)
+        highlighter.update(typedsofar)
+    highlighter = Highlighter(textarea, standardtext)
     return inner_onkeypress
 
+def poll_guesses(rootwindow, worker):
+    ''' Prints the latest guesses of the worker, if there are new ones, and
+    checks again every GUESS_POLL_MS '''
+    guess_str = worker.take_guess()
+    if guess_str is not None:
+        print(guess_str)
+    rootwindow.after(GUESS_POLL_MS, poll_guesses, rootwindow, worker)
+
 def build_textarea(rootwindow, showntext):
     ''' Creates text region.
     Also specifies tags for showing typed characters.  The tag types are:
@@ -103,7 +204,30 @@ def build_textarea(rootwindow, showntext):
     textarea.tag_configure('incorrect', background='red', foreground='black')
     return textarea
 
-def run_gui(showntext, _oracles_files=None):
+def load_oracle(filename):
+    ''' Loads a TyperOracle or HmmOracle saved by its save method, or pickled
+    by older versions; the oracle modules are only imported when one is
+    loaded, which keeps startup quick without --oracles '''
+    import typeroracle
+    import hmm_oracle
+    if not kd_store.is_store_file(filename):
+        with open(filename, 'rb') as ifh:
+            return pickle.load(ifh)
+    kind = kd_store.read_header(filename)['meta'].get('kind')
+    if kind == typeroracle.MODEL_KIND:
+        return typeroracle.TyperOracle.load(filename)
+    if kind == hmm_oracle.MODEL_KIND:
+        return hmm_oracle.HmmOracle.load(filename)
+    raise ValueError('%s does not hold an oracle' % filename)
+
+def dump_stats(stats_path, models):
+    ''' Writes the instrumentation stats of every model to stats_path; call it
+    from the thread running the models, or once they have stopped '''
+    instrumentation.write_json(
+        stats_path, {'%d:%s' % (i, type(model).__name__): model.stats()
+                     for i, model in enumerate(models)})
+
+def run_gui(showntext, _oracles_files=None, stats_path=None, snapshot_path=None):
     ''' Initializes global variables and starts gui '''
     standardtext = list(showntext)
     typedsofar = []
@@ -132,22 +256,46 @@ def run_gui(showntext, _oracles_files=None):
                                  'oracle/steven/steven_gettysburg2.txt'],
                       'joseph': ['oracle/joseph/joseph_obedience.txt', 'oracle/joseph/joseph_gettysburg.txt']}
 
-    kdidentifier = KDIdentifier(id_names_files,use_log_norm_pdf=True)
+    if snapshot_path is None:
+        # rebuilt only when the files above or the parameters change
+        kdidentifier = KDIdentifier.cached(id_names_files, use_log_norm_pdf=True)
+    elif os.path.exists(snapshot_path):
+        kdidentifier = KDIdentifier.load(snapshot_path)
+    else:
+        kdidentifier = KDIdentifier(id_names_files, use_log_norm_pdf=True)
+        kdidentifier.save(snapshot_path)
     oracle = None
 
     if _oracles_files is None:
         _oracles_files = []
     oracles = []
     for _o in _oracles_files:
-        with open(_o, "rb") as ifh:
-            oracle = pickle.load(ifh)
-            oracles.append(oracle)
+        oracle = load_oracle(_o)
+        oracles.append(oracle)
     rootwindow = tk.Tk()
     textarea = build_textarea(rootwindow, showntext)
+    worker = OracleWorker(kdidentifier, oracles, stats_path)
+    if stats_path is not None:
+        models = [kdidentifier] + oracles
+        for model in models:
+            model.enable_instrumentation()
+
+        # the worker writes the stats, as it is the one updating them
+        def periodic_dump():
+            worker.request_stats()
+            rootwindow.after(STATS_INTERVAL_MS, periodic_dump)
+        rootwindow.after(STATS_INTERVAL_MS, periodic_dump)
+    worker.start()
+    poll_guesses(rootwindow, worker)
     with open('log.keys', 'w') as ofh:
         rootwindow.bind('<Key>', onkeypress(
-            ofh, textarea, standardtext, typedsofar, kdidentifier, oracles))
+            ofh, textarea, standardtext, typedsofar, worker))
         rootwindow.mainloop()
+    worker.stop()
+    worker.join()
+    if stats_path is not None:
+        # the worker has stopped, so nothing updates the stats any more
+        dump_stats(stats_path, models)
 
 def get_text_from_file(filename):
     ''' Extract text from file '''
@@ -163,8 +311,16 @@ if __name__ == '__main__':
     parser.add_argument('--oracles', '-o',
                         nargs='*',
                         help='a list of the oracle files to use as oracles.')
+    parser.add_argument('--stats',
+                        help='record the time each identifier spends per '
+                        'keystroke, and write it to this file as JSON every '
+                        '%d seconds and on exit' % (STATS_INTERVAL_MS // 1000))
+    parser.add_argument('--snapshot',
+                        help='a KDIdentifier snapshot to load instead of '
+                        'training on the built-in files; if it does not '
+                        'exist, it is trained and saved there')
     args = parser.parse_args()
 
     text = get_text_from_file(args.source)
-    run_gui(text, args.oracles)
+    run_gui(text, args.oracles, args.stats, args.snapshot)
 
@@ -0,0 +1,99 @@
+"""
+Helpers for running training stages in parallel and timing them
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from contextlib import contextmanager
+import sys
+import time
+
+
+class StageTimer:
+    """
+    Records how long each named stage of a job takes, and optionally reports
+    stages and progress as they happen
+    """
+
+    def __init__(self, name, verbose=False, stream=None):
+        """
+         * name labels the job in reports
+         * verbose is whether to report stages and progress as they happen
+         * stream is where reports go; sys.stderr by default
+        """
+        self.name = name
+        self.verbose = verbose
+        self.stream = stream
+        self.timings = OrderedDict()
+
+    def log(self, message):
+        """
+        reports message, when verbose
+        """
+        if self.verbose:
+            print("[%s] %s" % (self.name, message),
+                  file=self.stream or sys.stderr, flush=True)
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        context manager timing the stage called stage_name
+        """
+        self.log("%s..." % stage_name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[stage_name] = self.timings.get(stage_name, 0.0) + \
+                elapsed
+            self.log("%s done in %.3fs" % (stage_name, elapsed))
+
+    def progress(self, stage_name, done, total):
+        """
+        reports that done out of total items of stage_name are finished
+        """
+        self.log("%s: %d/%d" % (stage_name, done, total))
+
+    def report(self):
+        """
+        returns a summary of the stage timings
+        """
+        lines = ["%-24s %8.3fs" % (stage_name, elapsed)
+                 for stage_name, elapsed in self.timings.items()]
+        lines.append("%-24s %8.3fs" % ("total", sum(self.timings.values())))
+        return "\n".join(lines)
+
+
+def parallel_map(func, items, workers=1, threads=False, on_done=None):
+    """
+     * func is the function to apply; with processes it must be defined at
+       module level so that it can be pickled
+     * items is a list of arguments, one per call
+     * workers is the number of worker processes (or threads); with 1 or
+       fewer, the calls run serially in this process
+     * threads is whether to use threads instead of processes, for work that
+       is mostly I/O or releases the GIL
+     * on_done, if given, is called with the number of finished calls after
+       each one finishes
+
+    returns the list of results, in the order of items
+    """
+    items = list(items)
+    if workers is None or workers <= 1 or len(items) <= 1:
+        results = []
+        for item in items:
+            results.append(func(item))
+            if on_done is not None:
+                on_done(len(results))
+        return results
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        done = 0
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            if on_done is not None:
+                on_done(done)
+        return [future.result() for future in futures]
@@ -0,0 +1,64 @@
+"""
+Serving many concurrent typers from one trained model
+
+KDIdentifier, TyperOracle and HmmOracle keep their trained model separate from
+the live state of each typer: model.new_session() returns a small session
+object, and model.step(session, ascii_code, timestamp) feeds it one keystroke
+and returns the current guess.  A SessionManager routes keystrokes to sessions
+by id, so thousands of live typers share a single model in memory.
+"""
+from collections import OrderedDict
+
+
+class SessionManager:
+    """
+    Routes keystrokes to per-typer sessions of one shared model
+    """
+
+    def __init__(self, model, max_sessions=None):
+        """
+         * model must provide new_session() and step(session, ascii_code,
+           timestamp), like KDIdentifier, TyperOracle and HmmOracle
+         * max_sessions, if given, bounds the number of live sessions; when a
+           new session would exceed it, the least recently used one is closed
+        """
+        self.model = model
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        """
+        returns the session for session_id, opening it if needed
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            if self.max_sessions is not None:
+                while len(self.sessions) >= self.max_sessions:
+                    self.sessions.popitem(last=False)
+            session = self.model.new_session()
+            self.sessions[session_id] = session
+        else:
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def process_keystroke(self, session_id, ascii_code, timestamp):
+        """
+         * session_id identifies the typer; any hashable value will do
+         * ascii_code is an integer code for the latest key press
+         * timestamp is a float of the timestamp for the key press
+
+        returns the model's current guess for that typer
+        """
+        return self.model.step(self.get(session_id), ascii_code, timestamp)
+
+    def close(self, session_id):
+        """
+        forgets the session for session_id, if there is one
+        """
+        self.sessions.pop(session_id, None)
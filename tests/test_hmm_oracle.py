@@ -0,0 +1,29 @@
+import os
+import pytest
+import hmm_oracle
+import kd_store
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "data")
+
+
+# numpy warns that the empty file holds no data, which is the point
+@pytest.mark.filterwarnings("ignore:loadtxt. input contained no data")
+def test_build_rejects_a_user_without_key_pairs(tmp_path, monkeypatch):
+    monkeypatch.setattr(kd_store, "CACHE_DIR", str(tmp_path / "cache"))
+    empty = tmp_path / "empty.txt"
+    empty.write_text("")
+    single = tmp_path / "single.txt"
+    single.write_text("104 1500000000.0\n")
+    training = {"steven": [os.path.join(DATA_DIR, "steven_gettysburg.txt")],
+                "nobody": [str(empty), str(single)]}
+    with pytest.raises(ValueError) as excinfo:
+        hmm_oracle.build_typeroracle(training)
+    message = str(excinfo.value)
+    assert "nobody" in message
+    assert str(empty) in message and str(single) in message
+
+
+def test_stack_sequences_rejects_only_empty_sequences():
+    with pytest.raises(ValueError):
+        hmm_oracle._stack_sequences([])
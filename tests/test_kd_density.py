@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import kd_density
+
+KernelDensity = pytest.importorskip("sklearn.neighbors").KernelDensity
+
+
+def _fit(bandwidth=kd_density.DEFAULT_BANDWIDTH):
+    rng = np.random.default_rng(0)
+    labeledtimelists = {
+        "fast": {(1, 2): rng.lognormal(-2.0, 0.4, 40),
+                 (2, 3): rng.lognormal(-1.6, 0.3, 25)},
+        "slow": {(1, 2): rng.lognormal(-1.2, 0.5, 30),
+                 (2, 3): rng.lognormal(-1.0, 0.4, 35)}}
+    userlist = ["fast", "slow"]
+    keypairlist = [(1, 2), (2, 3)]
+    densities = kd_density.GridDensities.fit(
+        userlist, keypairlist, labeledtimelists, bandwidth=bandwidth)
+    kdes = [[KernelDensity(bandwidth=bandwidth).fit(
+        np.reshape(labeledtimelists[user][keypair], (-1, 1)))
+        for keypair in keypairlist] for user in userlist]
+    return densities, kdes
+
+
+@pytest.mark.parametrize("timing", [0.05, 0.9, 3.0, 8.0, 60.0, -0.5])
+def test_logpdf_matches_exact_kde_inside_and_beyond_grid(timing):
+    densities, kdes = _fit()
+    for index in range(2):
+        expected = [kdes[user][index].score_samples([[timing]])[0]
+                    for user in range(2)]
+        np.testing.assert_allclose(densities.logpdf(index, timing), expected,
+                                   rtol=1e-4, atol=1e-4)
+
+
+def test_score_mixes_grid_and_exact_timings():
+    densities, kdes = _fit()
+    timings = np.array([0.1, 0.4, 3.0, 8.0])
+    expected = [kdes[user][1].score(timings.reshape(-1, 1))
+                for user in range(2)]
+    np.testing.assert_allclose(densities.score(1, timings), expected,
+                               rtol=1e-4)
+
+
+def test_select_keeps_samples_of_the_kept_keypairs():
+    densities, _ = _fit()
+    selected = densities.select(np.array([1]))
+    np.testing.assert_allclose(selected.logpdf(0, 8.0),
+                               densities.logpdf(1, 8.0))
+
+
+def test_densities_without_samples_clamp_to_the_grid():
+    densities, _ = _fit()
+    clamped = kd_density.GridDensities(densities.grid_start,
+                                       densities.grid_step, densities.table)
+    np.testing.assert_allclose(clamped.logpdf(0, 8.0),
+                               clamped.logpdf(0, kd_density.DEFAULT_GRID_MAX))
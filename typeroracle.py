@@ -9,29 +9,182 @@ import argparse
 import numpy as np
 import os
 import pickle
-from sklearn.neighbors import KernelDensity
 import sys
+import kd_density
+import kd_pairs
+import kd_store
+import pipeline
+from instrumentation import Instrumented, clock
 
 HISTORY_LENGTH = 200
+# identifies saved TyperOracles, and the version of their layout; version 2
+# grid models also keep their training timings, to score pauses exactly
+MODEL_KIND = "typeroracle"
+MODEL_VERSION = 2
 
-class TyperOracle:
+class TyperSession:
+    """
+    The live state of one typer being predicted by a shared TyperOracle
+
+    The last HISTORY_LENGTH key-pairs are kept in a ring buffer along with the
+    log-density of each under every user's model, and every legal key-pair
+    keeps the running total of those log-densities within the window, so a
+    keystroke only scores the timing entering the window and subtracts the
+    one leaving it.
+    """
+    __slots__ = ("last_timestamp", "last_keypress", "num_pairs", "position",
+                 "window_keypairs", "window_scores", "counts", "scores",
+                 "bestlabels", "votes")
+
+    def __init__(self, num_keypairs, num_users):
+        self.last_timestamp = -1
+        self.last_keypress = -1
+        self.num_pairs = 0
+        self.position = 0
+        # index of each key-pair in the window into the oracle's keypairlist,
+        # or -1 for key-pairs that are not scored
+        self.window_keypairs = np.full(HISTORY_LENGTH, -1, dtype=np.int64)
+        self.window_scores = np.zeros((HISTORY_LENGTH, num_users))
+        self.counts = np.zeros(num_keypairs, dtype=np.int64)
+        self.scores = np.zeros((num_keypairs, num_users))
+        self.bestlabels = np.full(num_keypairs, -1, dtype=np.int64)
+        self.votes = np.zeros(num_users, dtype=np.int64)
+
+class TyperOracle(Instrumented):
     """
     A struct to store information for predicting typer
+
+    The trained model is never modified after construction, so one oracle can
+    serve many typers at once, each with its own TyperSession (see sessions).
+    process_keystroke uses a default session of the oracle's own.
+    enable_instrumentation records the time of each stage of step, and stats()
+    returns it (see instrumentation).
     """
 
-    def __init__(self, keypairlist, userlist, labeledkdes):
+    def __init__(self, keypairlist, userlist, labeledkdes, densities=None):
         """
          * keypairlist must be a list of key-pair tuples
          * userlist must be a list of labels
-         * labeledkdes must be a dictionary of label: {keypair: kde}
+         * labeledkdes must be a dictionary of label: {keypair: kde}, or None
+           when densities is given
+         * densities, if given, must be a kd_density.GridDensities fitted for
+           userlist and keypairlist; it is used instead of labeledkdes
         """
         self.keypairlist = keypairlist
         self.userlist = userlist
         self.labeledkdes = labeledkdes
-        self.history = []
-        self.currentdata = {}
-        self.last_timestamp = -1
-        self.last_keypress = -1
+        self.densities = densities
+        self._index_keypairs()
+        self.session = self.new_session()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("session", None)
+        state.pop("keypairindex", None)
+        state.pop("instruments", None)
+        return state
+
+    def __setstate__(self, state):
+        # oracles pickled before sessions were split out carry their live state
+        for key in ("history", "currentdata", "last_timestamp",
+                    "last_keypress"):
+            state.pop(key, None)
+        state.setdefault("densities", None)
+        self.__dict__.update(state)
+        self._index_keypairs()
+        self.session = self.new_session()
+
+    def _index_keypairs(self):
+        """
+        maps each legal key-pair to its position in keypairlist
+        """
+        self.keypairindex = {k: i for i, k in enumerate(self.keypairlist)}
+
+    def save(self, path):
+        """
+        writes the trained model to path, as a kd_store file that load can
+        memory-map
+         * path is the name of the file to write
+        """
+        codes = np.array([kd_pairs.pair_code(k) for k in self.keypairlist],
+                         dtype=np.int32)
+        if (codes < 0).any():
+            raise ValueError("cannot save key-pairs with keys outside "
+                             "[0, %d)" % kd_pairs.KEY_RADIX)
+        meta = {"kind": MODEL_KIND,
+                "version": MODEL_VERSION,
+                "userlist": list(self.userlist)}
+        columns = {"keypairs": codes}
+        if self.densities is not None:
+            meta["density"] = "grid"
+            meta["grid_start"] = self.densities.grid_start
+            meta["grid_step"] = self.densities.grid_step
+            columns["table"] = self.densities.table
+            if self.densities.samples is not None:
+                meta["bandwidth"] = self.densities.bandwidth
+                columns["samples"] = self.densities.samples
+                columns["sample_offsets"] = self.densities.offsets
+        else:
+            # a KernelDensity is its training sample and bandwidth, so keep
+            # those and refit on load
+            meta["density"] = "exact"
+            kdes = [self.labeledkdes[user][keypair]
+                    for user in self.userlist for keypair in self.keypairlist]
+            samples = [np.asarray(kde.tree_.data).ravel() for kde in kdes]
+            columns["bandwidths"] = np.array([kde.bandwidth for kde in kdes],
+                                             dtype=np.float64)
+            columns["sample_offsets"] = np.concatenate(
+                ([0], np.cumsum([len(sample) for sample in samples])))
+            columns["samples"] = np.concatenate(samples) if samples \
+                else np.empty(0)
+        kd_store.write_columns(path, columns, meta)
+
+    @classmethod
+    def load(cls, path):
+        """
+        returns the TyperOracle saved to path by save; grid tables are
+        memory-mapped rather than read
+        """
+        meta, columns = kd_store.read_columns(path)
+        if meta.get("kind") != MODEL_KIND:
+            raise ValueError("%s does not hold a TyperOracle" % path)
+        if meta.get("version", 0) > MODEL_VERSION:
+            raise ValueError("%s was saved by a newer version (%r)" %
+                             (path, meta["version"]))
+        first, second = np.divmod(np.asarray(columns["keypairs"],
+                                             dtype=np.int64),
+                                  kd_pairs.KEY_RADIX)
+        keypairlist = list(zip(first.tolist(), second.tolist()))
+        userlist = meta["userlist"]
+        if meta["density"] == "grid":
+            densities = kd_density.GridDensities(
+                meta["grid_start"], meta["grid_step"], columns["table"],
+                columns.get("samples"), columns.get("sample_offsets"),
+                meta.get("bandwidth"))
+            return cls(keypairlist, userlist, None, densities)
+        offsets = columns["sample_offsets"]
+        # sklearn is slow to import, and only exact mode needs it
+        from sklearn.neighbors import KernelDensity
+        samples = columns["samples"]
+        bandwidths = columns["bandwidths"]
+        labeledkdes = {}
+        position = 0
+        for user in userlist:
+            labeledkdes[user] = {}
+            for keypair in keypairlist:
+                sample = np.array(
+                    samples[offsets[position]:offsets[position + 1]])
+                kde = KernelDensity(bandwidth=float(bandwidths[position]))
+                kde.fit(sample.reshape(-1, 1))
+                labeledkdes[user][keypair] = kde
+                position += 1
+        return cls(keypairlist, userlist, labeledkdes)
+
+    def new_session(self):
+        """
+        returns a TyperSession for a new typer
+        """
+        return TyperSession(len(self.keypairlist), len(self.userlist))
 
     def predict(self, data):
         """
@@ -40,13 +193,13 @@ class TyperOracle:
         returns the label that seems to best fit the data
         """
         votes = []
-        for k in self.keypairlist:
+        for index, k in enumerate(self.keypairlist):
             if k in data and len(data[k]) > 0:
                 bestscore = float("-inf")
                 bestlabel = -1
+                scores = self._score(index, data[k])
                 for i in range(len(self.userlist)):
-                    curscore = self.labeledkdes[self.userlist[i]][k].score(
-                        np.reshape(data[k], (len(data[k]), 1)))
+                    curscore = scores[i]
                     if curscore > bestscore:
                         bestscore = curscore
                         bestlabel = i
@@ -62,45 +215,193 @@ class TyperOracle:
          * ascii_code is an integer code for the latest key press
          * timestamp is a float of the timestamp for the key press
         """
-        if len(self.history) == 0 and self.last_keypress == -1:
-            self.last_keypress = ascii_code
-            self.last_timestamp = timestamp
+        return self.step(self.session, ascii_code, timestamp)
+
+    def step(self, session, ascii_code, timestamp):
+        """
+        for predicting live, for one of many typers
+         * session is the TyperSession of the typer
+         * ascii_code is an integer code for the latest key press
+         * timestamp is a float of the timestamp for the key press
+        """
+        if session.num_pairs == 0 and session.last_keypress == -1:
+            session.last_keypress = ascii_code
+            session.last_timestamp = timestamp
             return "I don't know"
-        self.history.append((self.last_keypress, ascii_code))
-        self.last_keypress = ascii_code
-        self._update_currentdata(timestamp)
-        self.last_timestamp = timestamp
-        return self.predict(self.currentdata)
+        instruments = self.instruments
+        if instruments is not None:
+            start = clock()
+        keypair = (session.last_keypress, ascii_code)
+        self._update_window(session, keypair, timestamp - session.last_timestamp)
+        session.last_keypress = ascii_code
+        session.last_timestamp = timestamp
+        if instruments is not None:
+            vote_start = clock()
+        if session.votes.any():
+            guess = self.userlist[np.argmax(session.votes)]
+        else:
+            guess = random.randint(0, len(self.userlist))
+        if instruments is not None:
+            end = clock()
+            instruments.record("vote", end - vote_start)
+            instruments.record("keystroke", end - start)
+            instruments.count("keystrokes")
+            instruments.tick()
+        return guess
+
+    def _score(self, index, timings):
+        """
+         * index is the position of a key-pair in keypairlist
+         * timings is a list of times elapsed between the key presses of the
+           key-pair
 
-    def _update_currentdata(self, timestamp):
+        returns an array with the total log-density of timings under each
+        user's model
+        """
+        if self.densities is not None:
+            return self.densities.score(index, timings)
+        keypair = self.keypairlist[index]
+        samples = np.reshape(timings, (len(timings), 1))
+        return np.array([self.labeledkdes[user][keypair].score(samples)
+                         for user in self.userlist])
+
+    def _logdensities(self, index, timing):
+        """
+         * index is the position of a key-pair in keypairlist
+         * timing is the time elapsed between the key presses of the key-pair
+
+        returns an array with the log-density of timing under each user's model
+        """
+        if self.densities is not None:
+            return self.densities.logpdf(index, timing)
+        keypair = self.keypairlist[index]
+        sample = np.array([[timing]])
+        return np.array([self.labeledkdes[user][keypair].score_samples(sample)[0]
+                         for user in self.userlist])
+
+    def _update_window(self, session, keypair, timing):
         """
         this method really shouldn't every be called outside of the class, since
-        this method will change the state of the class
-         * timestamp is a float of the timestamp for the latest key press
+        this method will change the state of the session; it pushes a key-pair
+        into the window, evicting the oldest one once the window is full
+         * session is the TyperSession to update
+         * keypair is the latest key-pair
+         * timing is the time elapsed between its key presses
         """
-        if self.history[-1] not in self.currentdata:
-            self.currentdata[self.history[-1]] = []
-        self.currentdata[self.history[-1]].append(timestamp - self.last_timestamp)
-        if len(self.history) > HISTORY_LENGTH:
-            if len(self.currentdata[self.history[0]]) == 1:
-                self.currentdata.pop(self.history[0])
-            else:
-                self.currentdata[self.history[0]].pop(0)
-            self.history = self.history[-HISTORY_LENGTH:]
-
-def build_typeroracle(training):
+        instruments = self.instruments
+        if instruments is not None:
+            start = clock()
+        position = session.position
+        if session.num_pairs >= HISTORY_LENGTH:
+            evicted = session.window_keypairs[position]
+            if evicted >= 0:
+                if instruments is not None:
+                    instruments.count("pairs_evicted")
+                session.counts[evicted] -= 1
+                if session.counts[evicted] == 0:
+                    # start afresh so rounding errors cannot build up
+                    session.scores[evicted] = 0.0
+                else:
+                    session.scores[evicted] -= session.window_scores[position]
+                self._update_vote(session, evicted)
+        index = self.keypairindex.get(keypair, -1)
+        density_time = 0.0
+        if index >= 0:
+            if instruments is not None:
+                density_start = clock()
+            scores = self._logdensities(index, timing)
+            if instruments is not None:
+                density_time = clock() - density_start
+                instruments.record("density", density_time)
+                instruments.count("pairs_scored")
+                instruments.count("density_evaluations", len(self.userlist))
+            session.window_scores[position] = scores
+            session.counts[index] += 1
+            session.scores[index] += scores
+            self._update_vote(session, index)
+        elif instruments is not None:
+            instruments.count("pairs_not_legal")
+        session.window_keypairs[position] = index
+        session.position = (position + 1) % HISTORY_LENGTH
+        session.num_pairs += 1
+        if instruments is not None:
+            # the window stage leaves out the density evaluation
+            instruments.record("window", clock() - start - density_time)
+
+    @staticmethod
+    def _update_vote(session, index):
+        """
+        recomputes which user the key-pair at index votes for, as predict would
+        """
+        bestlabel = -1
+        if session.counts[index] > 0:
+            scores = session.scores[index]
+            bestlabel = int(np.argmax(scores))
+            if not scores[bestlabel] > float("-inf"):
+                bestlabel = -1
+        previous = session.bestlabels[index]
+        if bestlabel != previous:
+            if previous >= 0:
+                session.votes[previous] -= 1
+            if bestlabel >= 0:
+                session.votes[bestlabel] += 1
+            session.bestlabels[index] = bestlabel
+
+def build_typeroracle(training, density="grid",
+                      bandwidth=kd_density.DEFAULT_BANDWIDTH, workers=1,
+                      timer=None, max_keypairs=None):
     """
      * training is a dictionary of label: [training files]
+     * density selects how the KDEs are evaluated: "grid" tabulates them with
+       kd_density.GridDensities, "exact" keeps one sklearn KernelDensity per
+       user and key-pair (slower; for validation)
+     * bandwidth is the bandwidth of the Gaussian kernels
+     * workers is the number of threads loading files and of processes
+       fitting per-user models
+     * timer, if given, is a pipeline.StageTimer that records the time of
+       each stage and reports progress
+     * max_keypairs, if given, must be at least 1; it keeps only that many
+       of the legal key-pairs, those that tell the users apart best and are
+       typed most (see _rank_keypairs)
 
     returns a TyperOracle
     """
+    if density not in ("grid", "exact"):
+        raise ValueError(
+            "unknown density %r; expected 'grid' or 'exact'" % density)
+    if max_keypairs is not None and max_keypairs < 1:
+        raise ValueError(
+            "max_keypairs must be at least 1, not %r" % max_keypairs)
+    if timer is None:
+        timer = pipeline.StageTimer("typeroracle")
     userlist = [label for label in training]
-    labeledtimelists = _get_training_data(training, userlist)
-    notinall = _get_limited_keypairs(userlist, labeledtimelists)
-    prekeypairlist = _get_legal_keypairs(labeledtimelists, notinall)
-    # TODO if there are too many KDEs, prune by choosing best N
-    keypairlist = prekeypairlist
-    labeledkdes = _build_labeledkdes(keypairlist, userlist, labeledtimelists)
+    with timer.stage("load"):
+        labeledtimelists = _get_training_data(
+            training, userlist, workers, timer)
+    with timer.stage("keypairs"):
+        keypairlist = _get_legal_keypairs(userlist, labeledtimelists)
+    timer.log("%d users, %d legal key-pairs" % (len(userlist), len(keypairlist)))
+    prune = max_keypairs is not None and len(keypairlist) > max_keypairs
+    densities = None
+    if density == "grid" or prune:
+        # the grid tables are the model, or at least rank the key-pairs
+        with timer.stage("fit" if density == "grid" else "fit grid"):
+            densities = _build_griddensities(
+                keypairlist, userlist, labeledtimelists, bandwidth, workers,
+                timer)
+    if prune:
+        with timer.stage("prune"):
+            keep = np.sort(_rank_keypairs(
+                densities, keypairlist, userlist,
+                labeledtimelists)[:max_keypairs])
+            keypairlist = [keypairlist[i] for i in keep]
+            densities = densities.select(keep)
+        timer.log("kept %d key-pairs" % len(keypairlist))
+    if density == "grid":
+        return TyperOracle(keypairlist, userlist, None, densities)
+    with timer.stage("fit"):
+        labeledkdes = _build_labeledkdes(
+            keypairlist, userlist, labeledtimelists, bandwidth, workers, timer)
     return TyperOracle(keypairlist, userlist, labeledkdes)
 
 def _load_data(filename):
@@ -109,96 +410,149 @@ def _load_data(filename):
     press and the second key press of each key-pair
      * filename is the name of a file from which to load data; each line should
        contain <integer><whitespace><float>, where the integer is an ascii key
-       code and the float is the timestamp when the key was pressed
+       code and the float is the timestamp when the key was pressed; binary
+       files written by kd_store are also accepted
 
-    returns dictionary of keypair: [timings]
+    returns dictionary of keypair: array of timings
     """
-    rawdata = np.loadtxt(filename)
-    asciicodes = rawdata[:, 0].astype(np.int64)
-    timestamps = rawdata[:, 1]
-
-    keypair = [(a, b) for a, b in zip(asciicodes[:-1], asciicodes[1:])]
-    timings = np.diff(timestamps)
+    return kd_pairs.group_files([filename]).to_dict()
 
-    result = {}
-    for k, time in zip(keypair, timings):
-        if k in result:
-            result[k].append(time)
-        else:
-            result[k] = [time]
-    return result
-
-def _get_training_data(training, userlist):
+def _get_training_data(training, userlist, workers=1, timer=None):
     """
      * training is a dictionary of label: [training files]
      * userlist is a list of users
+     * workers is the number of threads loading files
+     * timer, if given, is a pipeline.StageTimer to report progress to
 
-    returns a dictionary of label: {keypair: [timing]}
+    returns a dictionary of label: {keypair: array of timings}
     """
+    on_done = None
+    if timer is not None:
+        on_done = lambda done: timer.progress("load", done, len(userlist))
+    allgroups = pipeline.parallel_map(
+        kd_pairs.group_files, [training[label] for label in userlist],
+        workers, threads=True, on_done=on_done)
     labeledtimelists = {}
-    for label in userlist:
-        for filename in training[label]:
-            data = _load_data(filename)
-            if label not in labeledtimelists:
-                labeledtimelists[label] = {}
-            for keypair in data:
-                if keypair not in labeledtimelists[label]:
-                    labeledtimelists[label][keypair] = []
-                labeledtimelists[label][keypair].extend(data[keypair])
+    for label, groups in zip(userlist, allgroups):
+        labeledtimelists[label] = groups.to_dict()
     return labeledtimelists
 
-def _get_limited_keypairs(userlist, labeledtimelists):
+def _get_legal_keypairs(userlist, labeledtimelists):
     """
-    limited, as an antonym of universal: so this function grabs those key-pairs
-    not present in every user"s data
+    legal key-pairs are those present in every user's data
      * userlist is a list of users
      * labeledtimelists is a dictionary of label: {keypair: [timing]}
 
-    returns a dictionary of keypair: True
+    returns sorted list of legal key-pairs
     """
-    notinall = {}
-    for i in range(len(userlist)):
-        for j in range(i+1, len(userlist)):
-            for keypair in labeledtimelists[userlist[i]]:
-                if keypair not in labeledtimelists[userlist[j]]:
-                    notinall[keypair] = True
-    return notinall
+    legal = set(labeledtimelists[userlist[0]])
+    legal.intersection_update(
+        *[labeledtimelists[user] for user in userlist[1:]])
+    return sorted(legal)
 
-def _get_legal_keypairs(labeledtimelists, notinall):
+def _user_timelists(keypairlist, userlist, labeledtimelists):
     """
+    returns a list with, for each user, the timings of the legal key-pairs
+    """
+    return [{keypair: labeledtimelists[user][keypair]
+             for keypair in keypairlist} for user in userlist]
+
+def _rank_keypairs(densities, keypairlist, userlist, labeledtimelists):
+    """
+     * densities is a kd_density.GridDensities fitted for keypairlist
+     * keypairlist is a list of legal key-pairs
+     * userlist is a list of users
      * labeledtimelists is a dictionary of label: {keypair: [timing]}
-     * notinall denotes which key-pairs are not legal; it is a dictionary of
-       keypair: True
 
-    returns list of legal key-pairs
+    returns the positions of the key-pairs in keypairlist, most useful first;
+    a key-pair's worth is how far apart its users' densities are on average
+    (by Bhattacharyya distance) times how often it was typed, since a rare
+    key-pair seldom gets to vote and its densities are the noisiest
+    """
+    frequency = np.array([sum(len(labeledtimelists[user][keypair])
+                              for user in userlist)
+                          for keypair in keypairlist], dtype=np.float64)
+    return np.argsort(-densities.separability() * frequency, kind="stable")
+
+def _fit_user_grid(args):
     """
-    legal = []
-    for _, keypairs in labeledtimelists.items():
-        for keypair in keypairs:
-            if keypair not in notinall:
-                legal.append(keypair)
-        # we actually need only the first data set to determine what the legal
-        # key-pairs are
-        break
-    return legal
+    fits the grid densities of one user; runs in a worker process
+     * args is a tuple (timelists, keypairlist, bandwidth)
 
-def _build_labeledkdes(keypairlist, userlist, labeledtimelists):
+    returns an array of shape (key-pairs, grid points) of log-densities
     """
+    timelists, keypairlist, bandwidth = args
+    densities = kd_density.GridDensities.fit(
+        [None], keypairlist, {None: timelists}, bandwidth=bandwidth)
+    return densities.table[0]
+
+def _build_griddensities(keypairlist, userlist, labeledtimelists,
+                         bandwidth=kd_density.DEFAULT_BANDWIDTH, workers=1,
+                         timer=None):
+    """
+     * keypairlist is a list of legal key-pairs
+     * userlist is a list of users
      * labeledtimelists is a dictionary of label: {keypair: [timing]}
+     * bandwidth is the bandwidth of the Gaussian kernels
+     * workers is the number of processes fitting users
+     * timer, if given, is a pipeline.StageTimer to report progress to
+
+    returns a kd_density.GridDensities
+    """
+    on_done = None
+    if timer is not None:
+        on_done = lambda done: timer.progress("fit", done, len(userlist))
+    tables = pipeline.parallel_map(
+        _fit_user_grid,
+        [(timelists, keypairlist, bandwidth) for timelists in
+         _user_timelists(keypairlist, userlist, labeledtimelists)],
+        workers, on_done=on_done)
+    samples, offsets = kd_density.pack_samples(
+        [labeledtimelists[user][keypair]
+         for user in userlist for keypair in keypairlist])
+    return kd_density.GridDensities(
+        0.0, kd_density.DEFAULT_GRID_STEP, np.stack(tables), samples, offsets,
+        bandwidth)
+
+def _fit_user_kdes(args):
+    """
+    fits the KDEs of one user; runs in a worker process
+     * args is a tuple (timelists, keypairlist, bandwidth)
+
+    returns a dictionary of keypair: kde
+    """
+    from sklearn.neighbors import KernelDensity
+    timelists, keypairlist, bandwidth = args
+    kdes = {}
+    for keypair in keypairlist:
+        timings = timelists[keypair]
+        kde = KernelDensity(bandwidth=bandwidth)
+        kde.fit(np.reshape(timings, (len(timings), 1)))
+        kdes[keypair] = kde
+    return kdes
+
+def _build_labeledkdes(keypairlist, userlist, labeledtimelists,
+                       bandwidth=kd_density.DEFAULT_BANDWIDTH, workers=1,
+                       timer=None):
+    """
+     * keypairlist is a list of legal key-pairs
      * userlist is a list of users
      * labeledtimelists is a dictionary of label: {keypair: [timing]}
+     * bandwidth is the bandwidth of the Gaussian kernels
+     * workers is the number of processes fitting users
+     * timer, if given, is a pipeline.StageTimer to report progress to
 
     returns a dictionary of label: {keypair: kde}
     """
-    labeledkdes = {}
-    for user in userlist:
-        labeledkdes[user] = {}
-        for keypair in keypairlist:
-            timings = labeledtimelists[user][keypair]
-            kde = KernelDensity()
-            kde.fit(np.reshape(timings, (len(timings), 1)))
-            labeledkdes[user][keypair] = kde
-    return labeledkdes
+    on_done = None
+    if timer is not None:
+        on_done = lambda done: timer.progress("fit", done, len(userlist))
+    allkdes = pipeline.parallel_map(
+        _fit_user_kdes,
+        [(timelists, keypairlist, bandwidth) for timelists in
+         _user_timelists(keypairlist, userlist, labeledtimelists)],
+        workers, on_done=on_done)
+    return dict(zip(userlist, allkdes))
 
 def _kde_kl(kde_p, kde_q, n_samples=10**5):
     """
@@ -216,6 +570,25 @@ def _kde_kl(kde_p, kde_q, n_samples=10**5):
     log_q_samples, _ = kde_q.score_samples(samples)
     return log_p_samples.mean() - log_q_samples.mean()
 
+def load_typeroracle(filename):
+    """
+    returns the TyperOracle in filename, written by TyperOracle.save or, for
+    models trained before that format existed, pickled
+    """
+    if kd_store.is_store_file(filename):
+        return TyperOracle.load(filename)
+    with open(filename, "rb") as ifh:
+        return pickle.load(ifh)
+
+def _positive_int(text):
+    """
+    parses a command-line argument that must be a positive integer
+    """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not %d" % value)
+    return value
+
 def _train_model(args):
     """
     runs training task
@@ -225,17 +598,20 @@ def _train_model(args):
         curdir = os.path.join(args.dir, dirname)
         training[dirname] = [os.path.join(
             curdir, a) for a in os.listdir(curdir)]
-    oracle = build_typeroracle(training)
-    with open(args.out, "wb") as ofh:
-        pickle.dump(oracle, ofh)
+    timer = pipeline.StageTimer("typeroracle", verbose=args.verbose)
+    oracle = build_typeroracle(training, density=args.density,
+                               workers=args.workers, timer=timer,
+                               max_keypairs=args.max_keypairs)
+    with timer.stage("save"):
+        oracle.save(args.out)
+    timer.log("stage timings:\n" + timer.report())
 
 def _predict_user(args):
     """
     runs prediction task
     """
     data = _load_data(args.input)
-    with open(args.model, "rb") as ifh:
-        oracle = pickle.load(ifh)
+    oracle = load_typeroracle(args.model)
     print(oracle.predict(data))
 
 def _run():
@@ -258,6 +634,27 @@ def _run():
     trainparser.add_argument(
         "out",
         help="name of output file in which trained model is saved")
+    trainparser.add_argument(
+        "--density",
+        choices=["grid", "exact"],
+        default="grid",
+        help="how to evaluate the KDEs: tabulated on a grid (fast), or with "
+        "one sklearn KernelDensity per user and key-pair (for validation)")
+    trainparser.add_argument(
+        "--max-keypairs", "-n",
+        type=_positive_int,
+        help="keep only this many key-pairs, those that best tell the "
+        "users apart and are typed most often (default: keep every key-pair "
+        "all users have typed)")
+    trainparser.add_argument(
+        "--workers", "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes (default: number of CPUs)")
+    trainparser.add_argument(
+        "--verbose", "-v",
+        action="store_true",
+        help="report progress and per-stage timings")
     trainparser.set_defaults(func=_train_model)
 
     predictparser = subparsers.add_parser("predict", help="predict typer")